@@ -1,17 +1,30 @@
 from __future__ import annotations
 import os
+import hmac
 import json
 import logging
+import math
+import re
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import asyncio
+import contextlib
+import weakref
 import openai
-import requests
-from typing import Dict, List, Any
+import httpx
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from typing import Dict, List, Any, AsyncIterator, Awaitable, Callable, Iterable
 from dotenv import load_dotenv
 from duckduckgo_search import DDGS
-from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, Update
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram import InputFile
-from urllib.parse import quote
-from openai import OpenAI
+from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, Message, Update
+from telegram.error import BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from urllib.parse import quote, urlparse
+from openai import AsyncOpenAI
 
 # Настройка логирования
 logging.basicConfig(
@@ -49,7 +62,7 @@ if missing_tokens:
     raise ValueError(f"Необходимо задать следующие переменные окружения: {', '.join(missing_tokens)}")
 
 # Инициализация клиента OpenAI для Hugging Face
-client = OpenAI(
+client = AsyncOpenAI(
     base_url="https://api-inference.huggingface.co/models/microsoft/DialoGPT-medium",  # Пример HF модели для чата; измените на нужную
     api_key=HF_TOKEN,
 )
@@ -99,78 +112,285 @@ FEDERAL_DISTRICTS = {
     ]
 }
 
-# Функции для работы с администраторами
-def load_allowed_admins() -> List[int]:
-    """Загружает список ID администраторов из файла."""
-    try:
-        if not os.path.exists('allowed_admins.json'):
-            logger.warning("Файл allowed_admins.json не найден, создаётся новый.")
-            with open('allowed_admins.json', 'w', encoding='utf-8') as f:
-                json.dump([123456789], f, ensure_ascii=False)  # Замени на свой Telegram ID
-        with open('allowed_admins.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке allowed_admins.json: {str(e)}")
-        return [123456789]  # Замени на свой Telegram ID
+# Готовые клавиатуры; объекты Telegram неизменяемы, поэтому один экземпляр используется всеми пользователями
+ADMIN_MENU_MARKUP = ReplyKeyboardMarkup([
+    ['Управление пользователями', 'Загрузить файл'],
+    ['Архив документов РО', 'Документы для РО']
+], resize_keyboard=True)
+USER_MENU_MARKUP = ReplyKeyboardMarkup([
+    ['Загрузить файл'],
+    ['Архив документов РО', 'Документы для РО']
+], resize_keyboard=True)
+USER_MANAGEMENT_MARKUP = ReplyKeyboardMarkup([
+    ['Добавить пользователя', 'Добавить администратора'],
+    ['Список пользователей', 'Список администраторов'],
+    ['Удалить файл'],
+    ['Назад']
+], resize_keyboard=True)
+DISTRICT_PICKER_MARKUP = ReplyKeyboardMarkup([[district] for district in FEDERAL_DISTRICTS],
+                                             resize_keyboard=True, one_time_keyboard=True)
+REGION_PICKER_MARKUPS = {
+    district: ReplyKeyboardMarkup([[region] for region in regions], resize_keyboard=True, one_time_keyboard=True)
+    for district, regions in FEDERAL_DISTRICTS.items()
+}
+REGION_TO_DISTRICT = {region: district for district, regions in FEDERAL_DISTRICTS.items() for region in regions}
 
-def save_allowed_admins(allowed_admins: List[int]) -> None:
-    """Сохраняет список ID администраторов в файл."""
-    try:
-        with open('allowed_admins.json', 'w', encoding='utf-8') as f:
-            json.dump(allowed_admins, f, ensure_ascii=False, indent=2)
-            logger.info("Список администраторов сохранён.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении allowed_admins.json: {str(e)}")
+# Отложенная запись JSON-файлов
+PERSIST_DELAY = float(os.getenv("PERSIST_DELAY", "1.0"))  # За сколько секунд изменения одного файла сливаются в одну запись
 
-# Функции для работы с пользователями
-def load_allowed_users() -> List[int]:
-    """Загружает список ID разрешённых пользователей."""
+def write_json_atomic(path: str, data: Any) -> None:
+    """Записывает JSON во временный файл и подменяет им исходный, чтобы файл никогда не оставался недописанным."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix='.tmp', dir=directory)
     try:
-        if not os.path.exists('allowed_users.json'):
-            logger.warning("Файл allowed_users.json не найден, создаётся новый.")
-            with open('allowed_users.json', 'w', encoding='utf-8') as f:
-                json.dump([], f, ensure_ascii=False)
-        with open('allowed_users.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке allowed_users.json: {str(e)}")
-        return []
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
 
-def save_allowed_users(allowed_users: List[int]) -> None:
-    """Сохраняет список ID разрешённых пользователей."""
-    try:
-        with open('allowed_users.json', 'w', encoding='utf-8') as f:
-            json.dump(allowed_users, f, ensure_ascii=False, indent=2)
-            logger.info("Список пользователей сохранён.")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении allowed_users.json: {str(e)}")
+class JsonWriter:
+    """Отложенная атомарная запись JSON-файлов вне event loop.
+
+    schedule() только запоминает, как получить актуальное содержимое файла. Через delay секунд
+    снимок берётся один раз и записывается в отдельном потоке, так что серия изменений
+    (массовое добавление пользователей, поток регистраций) превращается в одну запись.
+    Вне event loop (при запуске) файл записывается сразу.
+    """
+
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.writes = 0
+        self._pending: Dict[str, tuple[Callable[[], Any], Callable[[], None] | None]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._flushing: asyncio.Event | None = None  # Создаётся внутри event loop
+
+    def schedule(self, path: str, snapshot: Callable[[], Any], after: Callable[[], None] | None = None) -> None:
+        """Ставит файл в очередь на запись; snapshot возвращает данные, after вызывается после записи."""
+        self._pending[path] = (snapshot, after)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_now(path)
+            return
+        if self._flushing is None:
+            self._flushing = asyncio.Event()
+        if path not in self._tasks:
+            self._tasks[path] = asyncio.create_task(self._write_later(path))
 
-# Функции для профилей пользователей
-def load_user_profiles() -> Dict[int, Dict[str, str]]:
-    """Загружает профили пользователей из файла."""
-    try:
-        if not os.path.exists('user_profiles.json'):
-            logger.warning("Файл user_profiles.json не найден, создаётся новый.")
-            with open('user_profiles.json', 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False)
-        with open('user_profiles.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        logger.error("Файл user_profiles.json повреждён, возвращается пустой словарь.")
-        return {}
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке user_profiles.json: {str(e)}")
-        return {}
+    def is_pending(self, path: str) -> bool:
+        """Есть ли у файла изменения, ещё не записанные на диск."""
+        return path in self._pending or path in self._tasks
 
-def save_user_profiles(profiles: Dict[int, Dict[str, str]]) -> None:
-    """Сохраняет профили пользователей в файл."""
-    try:
-        with open('user_profiles.json', 'w', encoding='utf-8') as f:
-            json.dump(profiles, f, ensure_ascii=False, indent=2)
-            logger.info(f"Профили успешно сохранены: {profiles}")
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении user_profiles.json: {str(e)}")
-        raise
+    def _write_now(self, path: str) -> None:
+        snapshot, after = self._pending.pop(path)
+        try:
+            write_json_atomic(path, snapshot())
+            self.writes += 1
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении {path}: {str(e)}")
+            return
+        if after is not None:
+            after()
+
+    async def _write_later(self, path: str) -> None:
+        try:
+            while path in self._pending:
+                try:
+                    await asyncio.wait_for(self._flushing.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+                await self._write(path)
+        finally:
+            del self._tasks[path]
+
+    async def _write(self, path: str) -> None:
+        snapshot, after = self._pending.pop(path)
+        try:
+            await asyncio.to_thread(write_json_atomic, path, snapshot())
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении {path}: {str(e)}")
+            if not self._flushing.is_set():
+                self._pending.setdefault(path, (snapshot, after))  # Повторим через delay секунд
+            return
+        self.writes += 1
+        logger.info(f"Файл {path} сохранён.")
+        if after is not None:
+            after()
+
+    async def flush(self) -> None:
+        """Немедленно записывает все отложенные изменения (при остановке бота)."""
+        if self._flushing is None:
+            return
+        self._flushing.set()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+JSON_WRITER = JsonWriter(PERSIST_DELAY)
+
+# Списки доступа (администраторы и пользователи)
+ACL_RELOAD_INTERVAL = float(os.getenv("ACL_RELOAD_INTERVAL", "10"))  # Как часто проверять, не изменились ли файлы со списками доступа
+
+class AccessList:
+    """Множество Telegram ID из JSON-файла.
+
+    Проверка `user_id in acl` выполняется за O(1). Изменения сохраняются атомарно,
+    а правки файла на диске (например, массовая загрузка ID) подхватываются через reload() без перезапуска.
+    """
+
+    def __init__(self, path: str, default: List[int]) -> None:
+        self.path = path
+        self.default = default
+        self._ids: set = set()
+        self._signature: tuple[int, int] | None = None
+        if not os.path.exists(path):
+            logger.warning(f"Файл {path} не найден, создаётся новый.")
+            self.save(set(default))
+        if not self.reload():
+            self._ids = set(default)
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._ids
+
+    def __iter__(self):
+        return iter(sorted(self._ids))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _file_signature(self) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> bool:
+        """Перечитывает файл, если он изменился с прошлого чтения. Возвращает True, если список обновлён."""
+        signature = self._file_signature()
+        if signature is None or signature == self._signature or JSON_WRITER.is_pending(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                ids = {int(user_id) for user_id in json.load(f)}
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке {self.path}: {str(e)}")
+            return False
+        self._signature = signature
+        if ids != self._ids:
+            logger.info(f"Загружен список доступа {self.path}: {len(ids)} ID")
+        self._ids = ids
+        return True
+
+    def add(self, user_id: int) -> bool:
+        """Добавляет ID и сохраняет файл. Возвращает False, если ID уже был в списке."""
+        if user_id in self._ids:
+            return False
+        self.save(self._ids | {user_id})
+        return True
+
+    def remove(self, user_id: int) -> bool:
+        """Удаляет ID и сохраняет файл. Возвращает False, если ID не было в списке."""
+        if user_id not in self._ids:
+            return False
+        self.save(self._ids - {user_id})
+        return True
+
+    def save(self, ids: set) -> None:
+        """Заменяет список и ставит файл в очередь на запись."""
+        self._ids = ids
+        JSON_WRITER.schedule(self.path, lambda: sorted(self._ids), after=self._remember_signature)
+
+    def _remember_signature(self) -> None:
+        # Собственная запись не должна восприниматься как правка файла извне
+        self._signature = self._file_signature()
+
+# Функции для профилей пользователей
+PROFILES_DB = os.getenv("PROFILES_DB", "profiles.db")  # Файл SQLite с профилями пользователей
+PROFILE_FIELDS = ("fio", "name", "region")
+
+class ProfileStore:
+    """Профили пользователей в SQLite (режим WAL) с копией в памяти.
+
+    Чтение идёт из памяти, ключи всегда int. Сохранение профиля — одна транзакция
+    с одной строкой, поэтому сбой при записи не затрагивает остальные профили.
+    При первом запуске профили переносятся из user_profiles.json.
+    """
+
+    def __init__(self, path: str, legacy_json: str = 'user_profiles.json') -> None:
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_profiles (
+                    user_id INTEGER PRIMARY KEY,
+                    fio TEXT,
+                    name TEXT,
+                    region TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            rows = self._conn.execute(f"SELECT user_id, {', '.join(PROFILE_FIELDS)} FROM user_profiles").fetchall()
+        self._profiles: Dict[int, Dict[str, str]] = {
+            row[0]: dict(zip(PROFILE_FIELDS, row[1:])) for row in rows
+        }
+        if not self._profiles and os.path.exists(legacy_json):
+            self._migrate(legacy_json)
+        logger.info(f"Загружено профилей пользователей: {len(self._profiles)}")
+
+    def _migrate(self, legacy_json: str) -> None:
+        try:
+            with open(legacy_json, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            logger.error(f"Не удалось прочитать {legacy_json} для переноса профилей: {str(e)}")
+            return
+        profiles = {int(user_id): {field: profile.get(field) for field in PROFILE_FIELDS}
+                    for user_id, profile in legacy.items()}
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_profiles (user_id, fio, name, region, updated_at) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, *(profile[field] for field in PROFILE_FIELDS), time.time())
+                 for user_id, profile in profiles.items()])
+        self._profiles = profiles
+        os.replace(legacy_json, f"{legacy_json}.migrated")
+        logger.info(f"Перенесено профилей из {legacy_json}: {len(profiles)}")
+
+    def __contains__(self, user_id: object) -> bool:
+        return user_id in self._profiles
+
+    def __getitem__(self, user_id: int) -> Dict[str, str]:
+        return self._profiles[user_id]
+
+    def __setitem__(self, user_id: int, profile: Dict[str, str]) -> None:
+        self._profiles[user_id] = profile
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def get(self, user_id: int, default: Any = None) -> Any:
+        return self._profiles.get(user_id, default)
+
+    async def save(self, user_id: int) -> None:
+        """Сохраняет на диск профиль одного пользователя. При ошибке выбрасывает исключение."""
+        profile = self._profiles[user_id]
+        await asyncio.to_thread(self._store, user_id, tuple(profile.get(field) for field in PROFILE_FIELDS))
+        logger.info(f"Профиль пользователя {user_id} сохранён.")
+
+    def _store(self, user_id: int, values: tuple) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_profiles (user_id, fio, name, region, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, *values, time.time()))
+
+    def close(self) -> None:
+        """Закрывает базу (все профили уже сохранены)."""
+        with self._lock:
+            self._conn.close()
 
 # Функции для базы знаний
 def load_knowledge_base() -> List[str]:
@@ -210,20 +430,186 @@ def remove_knowledge(fact: str, facts: List[str]) -> List[str]:
     return facts
 
 def save_knowledge_base(facts: List[str]) -> None:
-    """Сохраняет базу знаний в файл."""
+    """Ставит базу знаний в очередь на запись в файл."""
+    JSON_WRITER.schedule('knowledge_base.json', lambda: {"facts": list(facts)})
+    logger.info(f"База знаний с {len(facts)} фактами будет сохранена.")
+
+# Поиск релевантных фактов в базе знаний
+KNOWLEDGE_TOP_K = int(os.getenv("KNOWLEDGE_TOP_K", "8"))  # Сколько фактов максимум подставлять в запрос к ИИ
+KNOWLEDGE_TOKEN_BUDGET = int(os.getenv("KNOWLEDGE_TOKEN_BUDGET", "600"))  # Бюджет токенов на факты в одном запросе
+
+RUSSIAN_STOPWORDS = {
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она", "так", "его", "но",
+    "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее", "мне", "было", "вот", "от", "меня", "еще",
+    "нет", "о", "из", "ему", "теперь", "когда", "даже", "ну", "ли", "если", "уже", "или", "ни", "быть", "был",
+    "него", "до", "вас", "нибудь", "уж", "вам", "ведь", "там", "потом", "себя", "ничего", "ей", "может", "они",
+    "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя", "их", "чем", "была", "сам", "чтоб", "без", "чего",
+    "раз", "тоже", "себе", "под", "будет", "ж", "тогда", "кто", "этот", "того", "потому", "этого", "какой", "ним",
+    "здесь", "этом", "мой", "тем", "чтобы", "нее", "сейчас", "были", "куда", "зачем", "всех", "можно", "при", "об",
+    "хоть", "после", "над", "больше", "тот", "через", "эти", "нас", "про", "всего", "них", "какая", "много", "эту",
+    "моя", "свою", "этой", "перед", "том", "такой", "им", "более", "всю", "между", "это", "такое", "расскажи",
+    "скажи", "подскажи", "пожалуйста",
+}
+# Окончания для упрощённого стемминга (по мотивам Snowball), от длинных к коротким
+RUSSIAN_ENDINGS = sorted({
+    "ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом", "его", "ого", "ему",
+    "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею", "ла", "на", "ете", "йте", "ли", "ло", "но", "ет", "ют",
+    "ны", "ть", "ешь", "нно", "ила", "ыла", "ена", "ите", "или", "ыли", "ил", "ыл", "ен", "ило", "ыло", "ено",
+    "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "а", "ев", "ов", "ье", "е", "иями", "ями", "ами",
+    "еи", "ии", "и", "ией", "иям", "ям", "ием", "ам", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью", "ю",
+    "ия", "ья", "я", "ость", "ости", "остью",
+}, key=len, reverse=True)
+RUSSIAN_SUFFIXES = ("ованн", "ическ", "енн", "онн", "ск", "ов", "ев")  # Словообразовательные суффиксы: «форменной» и «форму» дают одну основу
+
+def stem_word(word: str) -> str:
+    """Упрощённо отсекает окончание и словообразовательный суффикс русского слова, оставляя основу не короче 3 букв."""
+    for reflexive in ("ся", "сь"):
+        if word.endswith(reflexive) and len(word) - 2 >= 4:
+            word = word[:-2]
+            break
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            word = word[:-len(ending)]
+            break
+    for suffix in RUSSIAN_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на нормализованные основы слов без стоп-слов."""
+    words = re.findall(r'\w+', text.lower().replace('ё', 'е'))
+    return [stem_word(word) for word in words if word not in RUSSIAN_STOPWORDS]
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов модели для русского текста (около 3 символов на токен)."""
+    return len(text) // 3 + 1
+
+class KnowledgeIndex:
+    """BM25-индекс фактов базы знаний.
+
+    Факт добавляется и удаляется из индекса по отдельности, без перестроения всего индекса,
+    поэтому /learn и /forget обновляют его сразу.
+    """
+
+    def __init__(self, facts: List[str], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self._terms: Dict[str, Counter] = {}  # Факт -> частоты основ в нём
+        self._postings: Dict[str, set] = {}  # Основа -> факты, в которых она встречается
+        self._total_length = 0
+        self._total_tokens = 0  # Оценка длины всех фактов в токенах модели
+        self.version = 0  # Увеличивается при каждом изменении набора фактов
+        for fact in facts:
+            self.add(fact)
+
+    def add(self, fact: str) -> None:
+        """Добавляет факт в индекс."""
+        if fact in self._terms:
+            return
+        terms = Counter(tokenize(fact))
+        self._terms[fact] = terms
+        self._total_length += sum(terms.values())
+        self._total_tokens += estimate_tokens(fact)
+        self.version += 1
+        for term in terms:
+            self._postings.setdefault(term, set()).add(fact)
+
+    def remove(self, fact: str) -> None:
+        """Удаляет факт из индекса."""
+        terms = self._terms.pop(fact, None)
+        if terms is None:
+            return
+        self._total_length -= sum(terms.values())
+        self._total_tokens -= estimate_tokens(fact)
+        self.version += 1
+        for term in terms:
+            facts = self._postings.get(term)
+            if facts is not None:
+                facts.discard(fact)
+                if not facts:
+                    del self._postings[term]
+
+    def search(self, query: str, top_k: int, token_budget: int) -> List[str]:
+        """Возвращает до top_k самых релевантных запросу фактов, суммарно не длиннее token_budget.
+
+        Если вся база умещается в бюджет, возвращаются все факты, самые релевантные первыми.
+        Если запрос не совпал ни с одним фактом, возвращаются первые факты базы в пределах бюджета.
+        """
+        if not self._terms:
+            return []
+        doc_count = len(self._terms)
+        avg_length = self._total_length / doc_count or 1
+        scores: Counter = Counter()
+        for term in set(tokenize(query)):
+            facts = self._postings.get(term)
+            if not facts:
+                continue
+            idf = math.log(1 + (doc_count - len(facts) + 0.5) / (len(facts) + 0.5))
+            for fact in facts:
+                tf = self._terms[fact][term]
+                length = sum(self._terms[fact].values())
+                scores[fact] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+        ranked = [fact for fact, _ in scores.most_common()]
+        fits_entirely = self._total_tokens <= token_budget
+        if fits_entirely or not ranked:
+            # Основы слов вопроса и факта могут не совпасть — лучше дать модели факты без ранжирования, чем ничего
+            ranked += [fact for fact in self._terms if fact not in scores]
+        limit = len(ranked) if fits_entirely else top_k
+        selected = []
+        used_tokens = 0
+        for fact in ranked:
+            if len(selected) >= limit:
+                break
+            fact_tokens = estimate_tokens(fact)
+            if used_tokens + fact_tokens > token_budget:
+                continue
+            selected.append(fact)
+            used_tokens += fact_tokens
+        return selected
+
+# Функции для кэша file_id отправленных файлов
+def load_file_id_cache() -> Dict[str, Dict[str, str]]:
+    """Загружает соответствие «путь на Диске -> версия файла и file_id в Telegram»."""
     try:
-        data = {"facts": facts}
-        with open('knowledge_base.json', 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-            logger.info(f"База знаний сохранена с {len(facts)} фактами.")
+        if not os.path.exists('file_id_cache.json'):
+            return {}
+        with open('file_id_cache.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
     except Exception as e:
-        logger.error(f"Ошибка при сохранении knowledge_base.json: {str(e)}")
+        logger.error(f"Ошибка при загрузке file_id_cache.json: {str(e)}")
+        return {}
+
+def save_file_id_cache(cache: Dict[str, Dict[str, str]]) -> None:
+    """Ставит кэш file_id в очередь на запись в файл."""
+    JSON_WRITER.schedule('file_id_cache.json', lambda: {path: dict(entry) for path, entry in cache.items()})
 
 # Инициализация глобальных переменных
-ALLOWED_ADMINS = load_allowed_admins()
-ALLOWED_USERS = load_allowed_users()
-USER_PROFILES = load_user_profiles()
+ALLOWED_ADMINS = AccessList('allowed_admins.json', [123456789])  # Замени на свой Telegram ID
+ALLOWED_USERS = AccessList('allowed_users.json', [])
+USER_PROFILES = ProfileStore(PROFILES_DB)
 KNOWLEDGE_BASE = load_knowledge_base()
+KNOWLEDGE_INDEX = KnowledgeIndex(KNOWLEDGE_BASE)
+FILE_ID_CACHE = load_file_id_cache()
+
+def user_role(user_id: int) -> str | None:
+    """Возвращает роль пользователя: 'admin', 'user' или None, если доступа нет."""
+    if user_id in ALLOWED_ADMINS:
+        return 'admin'
+    if user_id in ALLOWED_USERS:
+        return 'user'
+    return None
+
+def has_access(user_id: int) -> bool:
+    """Проверяет, может ли пользователь работать с ботом."""
+    return user_role(user_id) is not None
+
+async def watch_access_lists() -> None:
+    """Периодически подхватывает изменения файлов со списками доступа."""
+    while True:
+        await asyncio.sleep(ACL_RELOAD_INTERVAL)
+        ALLOWED_ADMINS.reload()
+        ALLOWED_USERS.reload()
 
 # Новый системный промпт для ИИ
 system_prompt = """
@@ -236,26 +622,867 @@ system_prompt = """
 Отвечай кратко, по делу, на русском языке, без лишних объяснений.
 """
 
+# Модели для HF (OpenAI-совместимые)
+LLM_MODELS = ["microsoft/DialoGPT-medium", "gpt2"]  # Примеры HF моделей; измените на нужные
+
+# Маршрутизация запросов между моделями
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "20"))  # Сколько секунд ждать первый фрагмент ответа модели
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "90"))  # Максимальная длительность генерации одного ответа
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "5"))  # Через сколько секунд запускать запасную модель, пока нет статистики
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.9"))  # Перцентиль задержки первого фрагмента для запуска запасной модели
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "3"))  # Сколько сбоев подряд отключают модель
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "120"))  # На сколько секунд отключается модель
+LLM_STATS_WINDOW = 100  # Сколько последних замеров задержки учитывать
+
+class AllModelsUnavailableError(Exception):
+    """Все модели временно отключены после недавних сбоев."""
+
+class ModelStats:
+    """Статистика задержек и ошибок одной модели вместе с состоянием автоматического отключения."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.successes = 0
+        self.errors = 0
+        self.hedges = 0
+        self.first_token = deque(maxlen=LLM_STATS_WINDOW)
+        self.durations = deque(maxlen=LLM_STATS_WINDOW)
+        self.failures_in_row = 0
+        self.disabled_until = 0.0
+        self.last_error = ""
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.disabled_until
+
+    def percentile(self, q: float, samples: Iterable[float] = None) -> float | None:
+        """Возвращает перцентиль q (0..1) задержки первого фрагмента или None, если замеров нет."""
+        values = sorted(self.first_token if samples is None else samples)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def record_first_token(self, latency: float) -> None:
+        self.first_token.append(latency)
+
+    def record_success(self, duration: float) -> None:
+        self.successes += 1
+        self.durations.append(duration)
+        self.failures_in_row = 0
+
+    def record_failure(self, model: str, error: BaseException) -> None:
+        """Учитывает сбой; 401, 429, 5xx и таймауты отключают модель на LLM_BREAKER_COOLDOWN секунд."""
+        self.errors += 1
+        self.last_error = str(error) or type(error).__name__
+        if isinstance(error, (openai.AuthenticationError, openai.RateLimitError)):
+            self.failures_in_row = max(self.failures_in_row + 1, LLM_BREAKER_THRESHOLD)
+        elif isinstance(error, (openai.InternalServerError, openai.APIConnectionError, asyncio.TimeoutError)) or \
+                (isinstance(error, openai.APIStatusError) and error.status_code >= 500):
+            self.failures_in_row += 1
+        else:
+            return
+        if self.failures_in_row >= LLM_BREAKER_THRESHOLD:
+            self.disabled_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+            logger.warning(f"Модель {model} отключена на {LLM_BREAKER_COOLDOWN:.0f} с после сбоя: {self.last_error}")
+
+class ModelRouter:
+    """Выбирает модель для ответа: таймауты, запасной запрос к следующей модели и отключение сбойных моделей."""
+
+    def __init__(self, models: List[str]) -> None:
+        self.models = models
+        self.stats = {model: ModelStats() for model in models}
+
+    def hedge_delay(self, model: str) -> float:
+        """Сколько ждать первый фрагмент от модели, прежде чем параллельно спросить следующую."""
+        delay = self.stats[model].percentile(LLM_HEDGE_PERCENTILE)
+        return min(delay, LLM_FIRST_TOKEN_TIMEOUT) if delay is not None else LLM_HEDGE_DELAY
+
+    @staticmethod
+    async def _next_text(chunks: AsyncIterator[Any]) -> str | None:
+        """Возвращает следующий непустой фрагмент ответа или None, если поток закончился."""
+        async for chunk in chunks:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                return delta
+        return None
+
+    async def _open(self, model: str, messages: List[Dict[str, str]]) -> tuple[Any, AsyncIterator[Any], str]:
+        """Открывает поток ответа модели и дожидается первого фрагмента."""
+        stream = await client.chat.completions.create(model=model, messages=messages, temperature=0.7, stream=True)
+        chunks = stream.__aiter__()
+        try:
+            first = await self._next_text(chunks)
+        except BaseException:
+            await stream.close()
+            raise
+        return stream, chunks, first or ""
+
+    async def _race(self, candidates: List[str], messages: List[Dict[str, str]]) -> tuple[str, float, Any, AsyncIterator[Any], str]:
+        """Запрашивает модели по очереди, подключая следующую, если текущая медлит; возвращает первую ответившую."""
+        pending: Dict[asyncio.Task, tuple[str, float]] = {}
+        queue = deque(candidates)
+        last_error: BaseException | None = None
+
+        def launch() -> str:
+            model = queue.popleft()
+            self.stats[model].requests += 1
+            task = asyncio.create_task(asyncio.wait_for(self._open(model, messages), LLM_FIRST_TOKEN_TIMEOUT))
+            pending[task] = (model, time.monotonic())
+            return model
+
+        current = launch()
+        try:
+            while pending:
+                timeout = self.hedge_delay(current) if queue else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Каждый запасной запрос — ещё одно обращение к HF, он расходует общую квоту
+                    if not LLM_ADMISSION.try_admit_background():
+                        logger.info(f"Модель {current} не ответила за {timeout:.1f} с, но общий лимит запросов исчерпан")
+                        continue
+                    self.stats[queue[0]].hedges += 1
+                    logger.info(f"Модель {current} не ответила за {timeout:.1f} с, параллельно запрашиваем {queue[0]}")
+                    current = launch()
+                    continue
+                for task in done:
+                    model, started = pending.pop(task)
+                    try:
+                        stream, chunks, first = task.result()
+                    except Exception as e:
+                        logger.error(f"Ошибка модели {model}: {str(e)}")
+                        self.stats[model].record_failure(model, e)
+                        last_error = e
+                        continue
+                    self.stats[model].record_first_token(time.monotonic() - started)
+                    return model, started, stream, chunks, first
+                if not pending and queue:
+                    if not LLM_ADMISSION.try_admit_background():
+                        logger.warning(f"Общий лимит запросов исчерпан, запасная модель {queue[0]} не запрашивается")
+                        break
+                    current = launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[0].close()
+        raise last_error or AllModelsUnavailableError()
+
+    def available_models(self) -> List[str]:
+        """Модели, не отключённые после сбоев, в порядке предпочтения."""
+        return [model for model in self.models if self.stats[model].available]
+
+    async def complete(self, messages: List[Dict[str, str]],
+                       on_text: Callable[[str], Awaitable[None]]) -> tuple[str, bool]:
+        """Генерирует ответ, передавая накопленный текст в on_text по мере поступления.
+
+        Возвращает текст и признак того, что генерация завершилась: если поток оборвался после
+        первых фрагментов, возвращается уже полученная часть ответа с False.
+        """
+        candidates = self.available_models()
+        if not candidates:
+            raise AllModelsUnavailableError()
+        model, started, stream, chunks, text = await self._race(candidates, messages)
+
+        async def consume() -> None:
+            nonlocal text
+            await on_text(text)
+            while (delta := await self._next_text(chunks)) is not None:
+                text += delta
+                await on_text(text)
+
+        finished = False
+        try:
+            await asyncio.wait_for(consume(), max(1.0, LLM_TIMEOUT - (time.monotonic() - started)))
+            self.stats[model].record_success(time.monotonic() - started)
+            finished = True
+        except Exception as e:
+            self.stats[model].record_failure(model, e)
+            if not text.strip():
+                raise
+            logger.error(f"Генерация {model} прервана: {str(e)}")
+        finally:
+            await stream.close()
+        logger.info(f"Ответ модели {model} за {time.monotonic() - started:.1f} с")
+        return text, finished
+
+    async def complete_once(self, messages: List[Dict[str, str]], max_tokens: int) -> str:
+        """Короткий служебный запрос без потоковой передачи к первой доступной модели, без запасных запусков."""
+        candidates = self.available_models()
+        if not candidates:
+            raise AllModelsUnavailableError()
+        model = candidates[0]
+        stats = self.stats[model]
+        stats.requests += 1
+        try:
+            completion = await asyncio.wait_for(
+                client.chat.completions.create(model=model, messages=messages, temperature=0.2, max_tokens=max_tokens),
+                LLM_TIMEOUT)
+        except Exception as e:
+            stats.record_failure(model, e)
+            raise
+        stats.successes += 1
+        stats.failures_in_row = 0
+        return (completion.choices[0].message.content or "").strip()
+
+    def describe(self) -> str:
+        """Текстовая сводка по моделям для команды /stats."""
+        lines = []
+        for model, stats in self.stats.items():
+            p50, p90 = stats.percentile(0.5), stats.percentile(0.9)
+            latency = f"{p50:.1f}/{p90:.1f} с" if p50 is not None else "нет данных"
+            duration = stats.percentile(0.5, stats.durations)
+            state = "доступна" if stats.available else \
+                f"отключена ещё на {stats.disabled_until - time.monotonic():.0f} с"
+            line = (f"{model}: {state}\nзапросов {stats.requests}, успешно {stats.successes}, ошибок {stats.errors}, "
+                    f"запасных запусков {stats.hedges}\nпервый фрагмент p50/p90: {latency}")
+            if duration is not None:
+                line += f", полный ответ p50: {duration:.1f} с"
+            if stats.last_error:
+                line += f"\nпоследняя ошибка: {stats.last_error[:200]}"
+            lines.append(line)
+        return "\n\n".join(lines)
+
+LLM_ROUTER = ModelRouter(LLM_MODELS)
+
+def llm_error_text(error: BaseException) -> str:
+    """Сообщение пользователю, когда ни одна модель не смогла ответить."""
+    if isinstance(error, AllModelsUnavailableError):
+        return "Все модели временно недоступны. Попробуйте позже."
+    if isinstance(error, openai.AuthenticationError):
+        return "Ошибка авторизации: неверный HF_TOKEN."
+    if isinstance(error, openai.RateLimitError):
+        return "Превышен лимит запросов. Попробуйте позже."
+    if isinstance(error, asyncio.TimeoutError):
+        return "Модели не ответили вовремя. Попробуйте позже."
+    if isinstance(error, openai.APIError):
+        return f"Ошибка API: {str(error)}"
+    return f"Неизвестная ошибка: {str(error)}"
+
+# Ограничение частоты запросов к ИИ и поиску
+LLM_USER_RATE = float(os.getenv("LLM_USER_RATE", "6"))  # Сколько вопросов в минуту может задать один пользователь
+LLM_USER_BURST = int(os.getenv("LLM_USER_BURST", "3"))  # Сколько вопросов подряд пользователь может задать без паузы
+LLM_GLOBAL_RATE = float(os.getenv("LLM_GLOBAL_RATE", "30"))  # Сколько запросов в минуту бот отправляет ИИ от всех пользователей
+LLM_GLOBAL_BURST = int(os.getenv("LLM_GLOBAL_BURST", "10"))  # Сколько запросов подряд бот может отправить ИИ без паузы
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))  # Сколько секунд вопрос может ждать в общей очереди
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "20"))  # Сколько вопросов может ждать в общей очереди одновременно
+
+class TokenBucket:
+    """Ведро токенов: capacity запросов подряд, затем не больше rate запросов в секунду."""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        """Забирает токен, если он есть."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def give_back(self) -> None:
+        """Возвращает токен, если запрос так и не был выполнен."""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится следующий токен."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else math.inf
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class AdmissionControl:
+    """Пропускает вопросы к ИИ с учётом личного лимита пользователя и общего лимита бота.
+
+    Личный лимит не даёт одному пользователю израсходовать общую квоту HF. Когда исчерпан общий
+    лимит, вопросы ждут в очереди в порядке поступления, пока не освободится токен или не истечёт
+    LLM_QUEUE_TIMEOUT.
+    """
+
+    def __init__(self, user_rate: float, user_burst: int, global_rate: float, global_burst: int,
+                 queue_timeout: float, queue_max: int) -> None:
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.queue_timeout = queue_timeout
+        self.queue_max = queue_max
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._user_buckets: Dict[int, TokenBucket] = {}
+        self._queue_lock: asyncio.Lock | None = None  # Создаётся внутри event loop
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_user = 0
+        self.rejected_global = 0
+        self.admitted_background = 0
+
+    def _user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._user_buckets.get(user_id)
+        if bucket is None:
+            if len(self._user_buckets) >= 1000:
+                # Полные вёдра ничем не отличаются от новых, их можно забыть
+                for key in [key for key, value in self._user_buckets.items() if value.full]:
+                    del self._user_buckets[key]
+            bucket = self._user_buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        return bucket
+
+    async def admit(self, user_id: int) -> str | None:
+        """Ждёт своей очереди; возвращает None, если запрос можно выполнять, иначе текст отказа."""
+        user_bucket = self._user_bucket(user_id)
+        if not user_bucket.take():
+            self.rejected_user += 1
+            logger.info(f"Пользователь {user_id} превысил личный лимит вопросов")
+            return f"Вы задаёте вопросы слишком часто. Попробуйте через {math.ceil(user_bucket.wait_time())} с."
+        if not self.waiting and self.global_bucket.take():
+            self.admitted += 1
+            return None
+        if self.waiting >= self.queue_max:
+            user_bucket.give_back()
+            self.rejected_global += 1
+            logger.warning(f"Очередь к ИИ переполнена, вопрос пользователя {user_id} отклонён")
+            return "Сейчас бот отвечает многим пользователям. Попробуйте через минуту."
+        if self._queue_lock is None:
+            self._queue_lock = asyncio.Lock()
+        self.waiting += 1
+        self.queued += 1
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            async with self._queue_lock:
+                while not self.global_bucket.take():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        user_bucket.give_back()
+                        self.rejected_global += 1
+                        logger.warning(f"Вопрос пользователя {user_id} не дождался очереди к ИИ")
+                        return "Сейчас бот отвечает многим пользователям. Попробуйте через минуту."
+                    await asyncio.sleep(min(self.global_bucket.wait_time(), remaining))
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        return None
+
+    def try_admit_background(self) -> bool:
+        """Забирает общий токен для фонового или запасного запроса, не обгоняя вопросы пользователей в очереди."""
+        if self.waiting or not self.global_bucket.take():
+            return False
+        self.admitted_background += 1
+        return True
+
+    def describe(self) -> str:
+        """Текстовая сводка счётчиков для команды /stats."""
+        return (f"Лимиты запросов: пропущено {self.admitted}, ждали в очереди {self.queued}, "
+                f"ждут сейчас {self.waiting}, отклонено по личному лимиту {self.rejected_user}, "
+                f"по общему лимиту {self.rejected_global}, фоновых и запасных запросов {self.admitted_background}")
+
+LLM_ADMISSION = AdmissionControl(LLM_USER_RATE / 60, LLM_USER_BURST, LLM_GLOBAL_RATE / 60, LLM_GLOBAL_BURST,
+                                 LLM_QUEUE_TIMEOUT, LLM_QUEUE_MAX)
+
 # Хранение истории переписки
-histories: Dict[int, Dict[str, Any]] = {}
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))  # Сколько токенов реплик хранить до сжатия в резюме
+HISTORY_SUMMARY_TOKEN_BUDGET = int(os.getenv("HISTORY_SUMMARY_TOKEN_BUDGET", "300"))  # Максимальный размер резюме
+HISTORY_TURN_TOKEN_LIMIT = int(os.getenv("HISTORY_TURN_TOKEN_LIMIT", "1000"))  # Максимальный размер одной реплики
+HISTORY_MAX_CHATS = int(os.getenv("HISTORY_MAX_CHATS", "500"))  # Сколько историй чатов держать в памяти
+HISTORY_IDLE_TTL = float(os.getenv("HISTORY_IDLE_TTL", str(6 * 3600)))  # Через сколько секунд простоя история выгружается из памяти
+HISTORY_DB = os.getenv("HISTORY_DB", "histories.db")  # Файл SQLite для историй; пустая строка — хранить только в памяти
+
+summary_prompt = """
+Сожми фрагмент переписки пользователя с чат-ботом в краткое резюме на русском языке.
+Сохрани имена, даты, договорённости и факты, важные для продолжения разговора. Не добавляй ничего от себя.
+"""
+
+async def summarize_dialogue(previous_summary: str, turns: List[Dict[str, str]], can_defer: bool = False) -> str | None:
+    """Сжимает старые реплики (вместе с прежним резюме) в новое резюме с помощью ИИ.
+
+    Запрос расходует общую квоту LLM_ADMISSION и идёт только к модели, которую LLM_ROUTER считает
+    доступной. Если квоты или доступных моделей нет, при can_defer возвращает None (сжатие откладывается),
+    иначе обрезает стенограмму без ИИ.
+    """
+    transcript = "\n".join(f"{'Пользователь' if turn['role'] == 'user' else 'Бот'}: {turn['content']}" for turn in turns)
+    if previous_summary:
+        transcript = f"Резюме предыдущей части: {previous_summary}\n{transcript}"
+    if LLM_ROUTER.available_models() and LLM_ADMISSION.try_admit_background():
+        try:
+            summary = await LLM_ROUTER.complete_once(
+                [{"role": "system", "content": summary_prompt}, {"role": "user", "content": transcript}],
+                HISTORY_SUMMARY_TOKEN_BUDGET)
+            if summary:
+                return trim_to_tokens(summary, HISTORY_SUMMARY_TOKEN_BUDGET)
+        except Exception as e:
+            logger.warning(f"Не удалось сжать историю с помощью ИИ: {str(e)}")
+    elif can_defer:
+        return None
+    # Запасной вариант: оставляем конец стенограммы, чтобы резюме не росло бесконечно
+    return transcript[-HISTORY_SUMMARY_TOKEN_BUDGET * 3:]
+
+class ChatHistory:
+    """История диалога одного чата с учётом токенов.
+
+    Реплики хранятся, пока их суммарный размер не превысит HISTORY_TOKEN_BUDGET; самые старые
+    вытесняются и в фоновой задаче сжимаются в резюме, которое подставляется в запрос вместо них.
+    """
+
+    def __init__(self) -> None:
+        self.turns: deque = deque()
+        self.tokens = 0
+        self.summary = ""
+        self.last_active = time.monotonic()
+        self._evicted: List[Dict[str, str]] = []  # Вытесненные реплики, ещё не попавшие в резюме
+        self._summary_task: asyncio.Task | None = None
+
+    def to_json(self) -> str:
+        """Сериализует историю для сохранения на диск."""
+        return json.dumps({"turns": list(self.turns), "summary": self.summary, "evicted": self._evicted},
+                          ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> ChatHistory:
+        """Восстанавливает историю, сохранённую методом to_json."""
+        history = cls()
+        state = json.loads(data)
+        history.turns.extend(state.get("turns", []))
+        history.tokens = sum(estimate_tokens(turn["content"]) for turn in history.turns)
+        history.summary = state.get("summary", "")
+        history._evicted = state.get("evicted", [])
+        return history
+
+    def add(self, role: str, content: str) -> None:
+        """Добавляет реплику и вытесняет старые, если история превысила бюджет токенов."""
+        self.last_active = time.monotonic()
+        content = trim_to_tokens(content, HISTORY_TURN_TOKEN_LIMIT)
+        self.turns.append({"role": role, "content": content})
+        self.tokens += estimate_tokens(content)
+        while self.tokens > HISTORY_TOKEN_BUDGET and len(self.turns) > 1:
+            turn = self.turns.popleft()
+            self.tokens -= estimate_tokens(turn["content"])
+            self._evicted.append(turn)
+        if self._evicted and self._summary_task is None:
+            self._summary_task = asyncio.create_task(self._summarize())
+
+    async def _summarize(self) -> None:
+        try:
+            while self._evicted:
+                # Реплики остаются в _evicted, пока резюме не обновлено: сохранение истории во время
+                # сжатия не должно терять ни их, ни резюме
+                turns = list(self._evicted)
+                # Пока вытесненного немного, сжатие можно отложить до следующей реплики, если квота ИИ исчерпана
+                can_defer = sum(estimate_tokens(turn["content"]) for turn in turns) <= HISTORY_TOKEN_BUDGET
+                summary = await summarize_dialogue(self.summary, turns, can_defer)
+                if summary is None:
+                    break
+                self.summary = summary
+                del self._evicted[:len(turns)]
+        finally:
+            self._summary_task = None
+
+class HistoryStore:
+    """Хранилище историй чатов: ограниченный LRU-кэш в памяти и (необязательно) SQLite на диске.
+
+    В памяти держится не больше max_chats историй, а простаивающие дольше idle_ttl выгружаются.
+    Если задан путь к базе, история сохраняется после каждой реплики и подгружается при следующем
+    обращении, поэтому переживает выгрузку из памяти и перезапуск бота.
+    """
+
+    def __init__(self, path: str, max_chats: int, idle_ttl: float) -> None:
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self._chats: OrderedDict[int, ChatHistory] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_history (
+                        chat_id INTEGER PRIMARY KEY,
+                        data TEXT NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+
+    async def get(self, chat_id: int) -> ChatHistory:
+        """Возвращает историю чата из памяти, с диска или новую."""
+        history = self._chats.get(chat_id)
+        if history is not None:
+            self._chats.move_to_end(chat_id)
+            return history
+        data = await asyncio.to_thread(self._load, chat_id)
+        history = self._chats.get(chat_id)  # Пока читали с диска, историю мог создать другой запрос
+        if history is None:
+            history = ChatHistory.from_json(data) if data else ChatHistory()
+            self._chats[chat_id] = history
+        while len(self._chats) > self.max_chats:
+            old_chat_id, old_history = self._chats.popitem(last=False)
+            await asyncio.to_thread(self._store, old_chat_id, old_history.to_json())
+        return history
+
+    async def save(self, chat_id: int, history: ChatHistory) -> None:
+        """Сохраняет историю чата на диск (одна запись в базе)."""
+        await asyncio.to_thread(self._store, chat_id, history.to_json())
+
+    async def evict_idle(self) -> None:
+        """Выгружает из памяти истории чатов, простаивающих дольше idle_ttl."""
+        deadline = time.monotonic() - self.idle_ttl
+        idle = [chat_id for chat_id, history in self._chats.items() if history.last_active < deadline]
+        for chat_id in idle:
+            history = self._chats.pop(chat_id)
+            await asyncio.to_thread(self._store, chat_id, history.to_json())
+        if idle:
+            logger.info(f"Выгружено из памяти {len(idle)} историй чатов, осталось {len(self._chats)}.")
+
+    async def close(self) -> None:
+        """Сохраняет все истории и закрывает базу."""
+        for chat_id, history in list(self._chats.items()):
+            await asyncio.to_thread(self._store, chat_id, history.to_json())
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def _load(self, chat_id: int) -> str | None:
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM chat_history WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, chat_id: int, data: str) -> None:
+        if self._conn is None:
+            return
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO chat_history (chat_id, data, updated_at) VALUES (?, ?, ?)",
+                               (chat_id, data, time.time()))
+
+HISTORY_STORE = HistoryStore(HISTORY_DB, HISTORY_MAX_CHATS, HISTORY_IDLE_TTL)
+
+async def evict_idle_histories() -> None:
+    """Периодически выгружает из памяти истории неактивных чатов."""
+    while True:
+        await asyncio.sleep(600)
+        await HISTORY_STORE.evict_idle()
+
+# Сборка контекста для ИИ
+CONTEXT_SEARCH_TOKEN_BUDGET = int(os.getenv("CONTEXT_SEARCH_TOKEN_BUDGET", "800"))  # Бюджет токенов на результаты поиска
+CONTEXT_DIALOGUE_TOKEN_BUDGET = int(os.getenv("CONTEXT_DIALOGUE_TOKEN_BUDGET", "1500"))  # Бюджет токенов на историю диалога
+
+def trim_to_tokens(text: str, budget: int) -> str:
+    """Обрезает текст так, чтобы его оценка в токенах не превышала budget."""
+    if estimate_tokens(text) <= budget:
+        return text
+    return text[:budget * 3].rstrip() + "…"
+
+def build_llm_messages(dialogue: Iterable[Dict[str, str]], user_input: str, knowledge_facts: List[str],
+                       search_text: str | None, summary: str = "") -> List[Dict[str, str]]:
+    """Собирает запрос к ИИ из отдельных частей, каждая — в пределах своего бюджета токенов.
+
+    Порядок: системный промпт, релевантные факты базы знаний, результаты поиска, резюме ранней
+    части разговора, последние реплики диалога (сколько помещается в бюджет) и текущий вопрос.
+    Факты и результаты поиска не сохраняются в истории и подставляются заново для каждого запроса.
+    """
+    messages = [{"role": "system", "content": system_prompt}]
+    if knowledge_facts:
+        messages.append({"role": "system",
+                         "content": "Известные факты для использования в ответах: " + "; ".join(knowledge_facts)})
+    if search_text:
+        messages.append({"role": "system",
+                         "content": f"Актуальные факты: {trim_to_tokens(search_text, CONTEXT_SEARCH_TOKEN_BUDGET)}"})
+    if summary:
+        messages.append({"role": "system", "content": f"Краткое содержание предыдущего разговора: {summary}"})
+    recent_turns = []
+    used_tokens = 0
+    for turn in reversed(list(dialogue)):
+        turn_tokens = estimate_tokens(turn["content"])
+        if used_tokens + turn_tokens > CONTEXT_DIALOGUE_TOKEN_BUDGET:
+            break
+        recent_turns.append(turn)
+        used_tokens += turn_tokens
+    messages.extend(reversed(recent_turns))
+    messages.append({"role": "user", "content": trim_to_tokens(user_input, HISTORY_TURN_TOKEN_LIMIT)})
+    return messages
+
+# Кэш ответов на частые вопросы
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # Сколько секунд ответ на вопрос считается актуальным
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))  # Максимум вопросов в кэше ответов
+ANSWER_CACHE_MIN_TERMS = 2  # Вопросы короче (вроде «а он?») зависят от контекста разговора и не кэшируются
+QUESTION_WORDS = {'кто', 'что', 'где', 'когда', 'куда', 'откуда', 'почему', 'зачем', 'как', 'сколько', 'какой',
+                  'какая', 'какое', 'какие', 'чей', 'чья', 'чьё', 'чье', 'можно', 'нельзя', 'не'}  # Меняют смысл вопроса, хотя и считаются служебными
+
+class AnswerCache:
+    """LRU-кэш ответов ИИ, ключ — основы слов вопроса и версия базы знаний.
+
+    Вопросы, отличающиеся только регистром, пунктуацией, окончаниями и служебными словами,
+    получают один ответ. После изменения базы знаний старые ответы больше не отдаются.
+    Кэшируются только ответы, сгенерированные без истории разговора, чтобы чужой контекст
+    не попадал к другим пользователям.
+    """
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, int, str]] = OrderedDict()
+
+    @staticmethod
+    def key(question: str) -> str | None:
+        """Возвращает ключ кэша для вопроса или None, если вопрос слишком короткий."""
+        terms = tokenize(question)
+        question_words = [word for word in normalize_query(question).split() if word in QUESTION_WORDS]
+        if not terms or len(question_words) + len(terms) < ANSWER_CACHE_MIN_TERMS:
+            return None
+        return ' '.join(question_words + terms)
+
+    def get(self, question: str, version: int) -> str | None:
+        key = self.key(question)
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            stored_at, stored_version, answer = entry
+            if stored_version == version and time.monotonic() - stored_at < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return answer
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, question: str, version: int, answer: str) -> None:
+        key = self.key(question)
+        if key is None:
+            return
+        self._entries[key] = (time.monotonic(), version, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+ANSWER_CACHE = AnswerCache(ANSWER_CACHE_TTL, ANSWER_CACHE_SIZE)
 
 # Функции для работы с Яндекс.Диском
-def create_yandex_folder(folder_path: str) -> bool:
+SUPPORTED_EXTENSIONS = ('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.cdr', '.eps', '.png', '.jpg', '.jpeg')
+YANDEX_TIMEOUT = float(os.getenv("YANDEX_TIMEOUT", "30"))  # Таймаут одного запроса к Диску, секунды
+YANDEX_MAX_CONCURRENCY = int(os.getenv("YANDEX_MAX_CONCURRENCY", "10"))  # Максимум одновременных запросов к Диску
+YANDEX_FOLDER_CACHE_TTL = float(os.getenv("YANDEX_FOLDER_CACHE_TTL", "600"))  # Сколько секунд считаем папку существующей
+YANDEX_LISTING_TTL = float(os.getenv("YANDEX_LISTING_TTL", "60"))  # Сколько секунд список папки считается свежим
+YANDEX_LISTING_STALE_TTL = float(os.getenv("YANDEX_LISTING_STALE_TTL", "600"))  # Сколько ещё отдаём устаревший список, обновляя его в фоне
+YANDEX_LISTING_CACHE_SIZE = int(os.getenv("YANDEX_LISTING_CACHE_SIZE", "256"))  # Максимум папок в кэше списков
+YANDEX_PAGE_SIZE = int(os.getenv("YANDEX_PAGE_SIZE", "100"))  # Размер страницы при постраничном чтении папок
+FILE_LIST_PAGE_SIZE = int(os.getenv("FILE_LIST_PAGE_SIZE", "20"))  # Сколько элементов папки региона показывать на одной странице
+TELEGRAM_SEND_LIMIT_MB = 20  # Максимальный размер файла, который бот отправляет пользователю
+TRANSFER_CHUNK_SIZE = 256 * 1024  # Размер блока при потоковой передаче файлов
+TRANSFER_SPOOL_SIZE = int(os.getenv("TRANSFER_SPOOL_SIZE", str(1024 * 1024)))  # Файлы крупнее буферизуются на диске, а не в памяти
+TRANSFER_MAX_CONCURRENCY = int(os.getenv("TRANSFER_MAX_CONCURRENCY", "3"))  # Максимум одновременных передач файлов в Telegram
+FILE_CACHE_DIR = os.getenv("FILE_CACHE_DIR", "file_cache")  # Каталог локального кэша содержимого файлов (по md5)
+FILE_CACHE_MAX_MB = float(os.getenv("FILE_CACHE_MAX_MB", "200"))  # Предельный размер локального кэша файлов
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "3"))  # Сколько раз пытаться загрузить файл на Диск
+PROGRESS_EDIT_INTERVAL = 2.0  # Не чаще раза в столько секунд обновляем сообщение о ходе загрузки
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "3"))  # Сколько загрузок на Диск выполняется одновременно
+TELEGRAM_DOWNLOAD_TIMEOUT = float(os.getenv("TELEGRAM_DOWNLOAD_TIMEOUT", "60"))  # Таймаут чтения при скачивании файла из Telegram, секунды
+UPLOAD_DRAIN_TIMEOUT = float(os.getenv("UPLOAD_DRAIN_TIMEOUT", "30"))  # Сколько секунд при остановке дожидаться очереди загрузок
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+_yandex_client: httpx.AsyncClient | None = None
+_disk_download_client: httpx.AsyncClient | None = None
+_telegram_files_client: httpx.AsyncClient | None = None
+_yandex_semaphore: asyncio.Semaphore | None = None
+_transfer_semaphore: asyncio.Semaphore | None = None
+_known_folders: Dict[str, float] = {}  # Путь папки -> момент (time.monotonic), до которого она считается существующей
+
+def get_yandex_client() -> httpx.AsyncClient:
+    """Возвращает общий HTTP-клиент для Яндекс.Диска (пул keep-alive соединений)."""
+    global _yandex_client
+    if _yandex_client is None or _yandex_client.is_closed:
+        _yandex_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(YANDEX_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=YANDEX_MAX_CONCURRENCY,
+                                max_keepalive_connections=YANDEX_MAX_CONCURRENCY),
+            follow_redirects=True,
+        )
+    return _yandex_client
+
+def get_disk_download_client() -> httpx.AsyncClient:
+    """Возвращает HTTP-клиент для скачивания файлов с Диска.
+
+    Долгие скачивания идут через отдельный пул, чтобы не занимать соединения, нужные запросам к API Диска.
+    """
+    global _disk_download_client
+    if _disk_download_client is None or _disk_download_client.is_closed:
+        _disk_download_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(YANDEX_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=TRANSFER_MAX_CONCURRENCY,
+                                max_keepalive_connections=TRANSFER_MAX_CONCURRENCY),
+            follow_redirects=True,
+        )
+    return _disk_download_client
+
+async def close_yandex_client() -> None:
+    """Закрывает HTTP-клиенты Яндекс.Диска при остановке бота."""
+    global _yandex_client, _disk_download_client
+    for http_client in (_yandex_client, _disk_download_client):
+        if http_client is not None and not http_client.is_closed:
+            await http_client.aclose()
+    _yandex_client = None
+    _disk_download_client = None
+
+def get_telegram_files_client() -> httpx.AsyncClient:
+    """Возвращает HTTP-клиент для скачивания файлов из Telegram, отдельный от пула соединений Диска."""
+    global _telegram_files_client
+    if _telegram_files_client is None or _telegram_files_client.is_closed:
+        _telegram_files_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(TELEGRAM_DOWNLOAD_TIMEOUT, connect=10.0),
+            limits=httpx.Limits(max_connections=UPLOAD_WORKERS, max_keepalive_connections=UPLOAD_WORKERS),
+            follow_redirects=True,
+        )
+    return _telegram_files_client
+
+async def close_telegram_files_client() -> None:
+    """Закрывает HTTP-клиент для файлов Telegram при остановке бота."""
+    global _telegram_files_client
+    if _telegram_files_client is not None and not _telegram_files_client.is_closed:
+        await _telegram_files_client.aclose()
+    _telegram_files_client = None
+
+async def yandex_request(method: str, url: str, auth: bool = True, **kwargs: Any) -> httpx.Response:
+    """Выполняет запрос к Яндекс.Диску с ограничением числа одновременных запросов."""
+    global _yandex_semaphore
+    if _yandex_semaphore is None:
+        _yandex_semaphore = asyncio.Semaphore(YANDEX_MAX_CONCURRENCY)
+    headers = kwargs.pop('headers', {})
+    if auth:
+        headers['Authorization'] = f'OAuth {YANDEX_TOKEN}'
+    async with _yandex_semaphore:
+        return await get_yandex_client().request(method, url, headers=headers, **kwargs)
+
+class ListingCache:
+    """LRU-кэш содержимого папок Яндекс.Диска, общий для всех пользователей.
+
+    Свежая запись отдаётся сразу. Устаревшая (но не старше stale_ttl) тоже отдаётся сразу,
+    а обновление запускается в фоне. Одновременные запросы одной папки делят одну загрузку.
+    """
+
+    def __init__(self, ttl: float, stale_ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._epoch = 0  # Увеличивается при каждой инвалидации, чтобы не сохранять ответы, начатые до неё
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает содержимое папки (или страницы папки) из кэша или загружает его через fetch."""
+        entry = self._entries.get(key)
+        if entry is not None:
+            fetched_at, items = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                if age >= self.ttl:
+                    self._refresh(key, fetch)
+                return items
+        return await asyncio.shield(self._refresh(key, fetch))
+
+    def invalidate(self, folder_path: str) -> None:
+        """Сбрасывает кэш папки, её страниц и всех вложенных папок."""
+        prefixes = (folder_path.rstrip('/') + '/', folder_path + '?')
+        for key in [key for key in self._entries if key == folder_path or key.startswith(prefixes)]:
+            del self._entries[key]
+        for key in [key for key in self._pending if key == folder_path or key.startswith(prefixes)]:
+            del self._pending[key]
+        self._epoch += 1
+
+    def _refresh(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, fetch))
+            self._pending[key] = task
+        return task
+
+    async def _load(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        epoch = self._epoch
+        try:
+            items = await fetch()
+        finally:
+            if self._pending.get(key) is asyncio.current_task():
+                del self._pending[key]
+        if items is not None and epoch == self._epoch:
+            self._entries[key] = (time.monotonic(), items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return items
+
+LISTING_CACHE = ListingCache(YANDEX_LISTING_TTL, YANDEX_LISTING_STALE_TTL, YANDEX_LISTING_CACHE_SIZE)
+
+def normalize_disk_path(path: str) -> str:
+    """Приводит путь Яндекс.Диска к виду /a/b без префикса disk: и завершающего слэша."""
+    if path.startswith('disk:'):
+        path = path[len('disk:'):]
+    return '/' + path.strip('/')
+
+def remember_yandex_folder(folder_path: str) -> None:
+    """Запоминает, что папка существует на Яндекс.Диске."""
+    _known_folders[normalize_disk_path(folder_path)] = time.monotonic() + YANDEX_FOLDER_CACHE_TTL
+
+def is_known_yandex_folder(folder_path: str) -> bool:
+    """Проверяет по кэшу, известно ли, что папка существует."""
+    folder_path = normalize_disk_path(folder_path)
+    expires_at = _known_folders.get(folder_path)
+    if expires_at is None:
+        return False
+    if expires_at < time.monotonic():
+        _known_folders.pop(folder_path, None)
+        return False
+    return True
+
+def forget_yandex_folder(folder_path: str) -> None:
+    """Удаляет папку и все вложенные в неё папки из кэша существующих папок."""
+    folder_path = normalize_disk_path(folder_path)
+    prefix = folder_path.rstrip('/') + '/'
+    for path in [path for path in _known_folders if path == folder_path or path.startswith(prefix)]:
+        _known_folders.pop(path, None)
+    LISTING_CACHE.invalidate(folder_path)
+    logger.info(f"Папка {folder_path} удалена из кэша существующих папок.")
+
+async def create_yandex_folder(folder_path: str) -> bool:
     """Создаёт папку на Яндекс.Диске."""
     folder_path = folder_path.rstrip('/')
+    if is_known_yandex_folder(folder_path):
+        return True
     url = f'https://cloud-api.yandex.net/v1/disk/resources?path={quote(folder_path)}'
-    headers = {'Authorization': f'OAuth {YANDEX_TOKEN}', 'Content-Type': 'application/json'}
+    headers = {'Content-Type': 'application/json'}
     try:
-        response = requests.get(url, headers=headers)
+        response = await yandex_request('GET', url, headers=headers)
         if response.status_code == 200:
             logger.info(f"Папка {folder_path} уже существует.")
+            remember_yandex_folder(folder_path)
             return True
         if response.status_code == 401:
             logger.error(f"401 Unauthorized для папки {folder_path}. Проверьте YANDEX_TOKEN (возможно, истёк или неверный).")
             return False
-        response = requests.put(url, headers=headers)
+        response = await yandex_request('PUT', url, headers=headers)
         if response.status_code in (201, 409):
             logger.info(f"Папка {folder_path} создана.")
+            remember_yandex_folder(folder_path)
+            if response.status_code == 201:
+                LISTING_CACHE.invalidate(normalize_disk_path(folder_path.rsplit('/', 1)[0]))
             return True
         if response.status_code == 401:
             logger.error(f"401 Unauthorized при создании {folder_path}. Проверьте YANDEX_TOKEN.")
@@ -266,144 +1493,358 @@ def create_yandex_folder(folder_path: str) -> bool:
         logger.error(f"Ошибка при создании папки {folder_path}: {str(e)}")
         return False
 
-def list_yandex_disk_items(folder_path: str, item_type: str = None) -> List[Dict[str, str]]:
-    """Возвращает список элементов (файлов или директорий) в папке на Яндекс.Диске."""
-    folder_path = folder_path.rstrip('/')
-    url = f'https://cloud-api.yandex.net/v1/disk/resources?path={quote(folder_path)}&fields=_embedded.items.name,_embedded.items.type,_embedded.items.path&limit=100'
-    headers = {'Authorization': f'OAuth {YANDEX_TOKEN}'}
+async def fetch_yandex_disk_page(folder_path: str, offset: int, limit: int) -> Dict[str, Any] | None:
+    """Запрашивает одну страницу содержимого папки: {'items': [...], 'total': N}; при ошибке возвращает None."""
+    url = (f'https://cloud-api.yandex.net/v1/disk/resources?path={quote(folder_path)}'
+           f'&fields=_embedded.items.name,_embedded.items.type,_embedded.items.path,_embedded.items.size,'
+           f'_embedded.items.md5,_embedded.items.modified,_embedded.total'
+           f'&limit={limit}&offset={offset}&sort=name')
     try:
-        response = requests.get(url, headers=headers)
+        response = await yandex_request('GET', url)
         if response.status_code == 200:
-            items = response.json().get('_embedded', {}).get('items', [])
-            if item_type:
-                return [item for item in items if item['type'] == item_type]
-            return items
+            embedded = response.json().get('_embedded', {})
+            items = embedded.get('items', [])
+            remember_yandex_folder(folder_path)
+            for item in items:
+                if item['type'] == 'dir':
+                    remember_yandex_folder(f"{folder_path}/{item['name']}")
+            return {'items': items, 'total': embedded.get('total', offset + len(items))}
         if response.status_code == 401:
             logger.error(f"401 Unauthorized для списка элементов в {folder_path}. Проверьте YANDEX_TOKEN.")
-            return []
+            return None
+        if response.status_code == 404:
+            forget_yandex_folder(folder_path)
         logger.error(f"Ошибка Яндекс.Диска: код {response.status_code}, ответ: {response.text}")
-        return []
+        return None
     except Exception as e:
         logger.error(f"Ошибка при запросе списка элементов в {folder_path}: {str(e)}")
-        return []
+        return None
+
+async def fetch_yandex_disk_items(folder_path: str) -> List[Dict[str, str]] | None:
+    """Запрашивает всё содержимое папки постранично; при ошибке возвращает None."""
+    items = []
+    while True:
+        page = await fetch_yandex_disk_page(folder_path, len(items), YANDEX_PAGE_SIZE)
+        if page is None:
+            return None
+        items.extend(page['items'])
+        if not page['items'] or len(items) >= page['total']:
+            return items
+
+async def iter_yandex_disk_items(folder_path: str, item_type: str = None,
+                                 page_size: int = YANDEX_PAGE_SIZE) -> AsyncIterator[Dict[str, str]]:
+    """Лениво перебирает элементы папки, запрашивая следующую страницу только по мере необходимости."""
+    folder_path = normalize_disk_path(folder_path)
+    offset = 0
+    while True:
+        page = await fetch_yandex_disk_page(folder_path, offset, page_size)
+        if page is None:
+            return
+        for item in page['items']:
+            if not item_type or item['type'] == item_type:
+                yield item
+        offset += len(page['items'])
+        if not page['items'] or offset >= page['total']:
+            return
+
+async def get_yandex_disk_page(folder_path: str, offset: int, limit: int) -> Dict[str, Any] | None:
+    """Возвращает страницу содержимого папки через общий кэш списков."""
+    folder_path = normalize_disk_path(folder_path)
+    key = f"{folder_path}?offset={offset}&limit={limit}"
+    return await LISTING_CACHE.get(key, lambda: fetch_yandex_disk_page(folder_path, offset, limit))
+
+async def list_yandex_disk_items(folder_path: str, item_type: str = None) -> List[Dict[str, str]]:
+    """Возвращает список элементов (файлов или директорий) в папке на Яндекс.Диске."""
+    folder_path = normalize_disk_path(folder_path)
+    items = await LISTING_CACHE.get(folder_path, lambda: fetch_yandex_disk_items(folder_path)) or []
+    if item_type:
+        return [item for item in items if item['type'] == item_type]
+    return items
 
-def list_yandex_disk_directories(folder_path: str) -> List[str]:
+async def list_yandex_disk_directories(folder_path: str) -> List[str]:
     """Возвращает список имен поддиректорий в папке."""
-    items = list_yandex_disk_items(folder_path, item_type='dir')
+    items = await list_yandex_disk_items(folder_path, item_type='dir')
     return [item['name'] for item in items]
 
-def list_yandex_disk_files(folder_path: str) -> List[Dict[str, str]]:
+async def list_yandex_disk_files(folder_path: str) -> List[Dict[str, str]]:
     """Возвращает список файлов в папке на Яндекс.Диске (с фильтром по расширениям)."""
     folder_path = folder_path.rstrip('/')
-    items = list_yandex_disk_items(folder_path, item_type='file')
-    supported_extensions = ('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.cdr', '.eps', '.png', '.jpg', '.jpeg')
-    files = [item for item in items if item['name'].lower().endswith(supported_extensions)]
+    items = await list_yandex_disk_items(folder_path, item_type='file')
+    files = [item for item in items if item['name'].lower().endswith(SUPPORTED_EXTENSIONS)]
     logger.info(f"Найдено {len(files)} файлов в папке {folder_path}: {[item['name'] for item in files]}")
     return files
 
-def get_yandex_disk_file(file_path: str) -> str | None:
+async def get_yandex_disk_file(file_path: str) -> str | None:
     """Получает ссылку для скачивания файла с Яндекс.Диска."""
     file_path = file_path.rstrip('/')
     encoded_path = quote(file_path, safe='/')
     url = f'https://cloud-api.yandex.net/v1/disk/resources/download?path={encoded_path}'
-    headers = {'Authorization': f'OAuth {YANDEX_TOKEN}'}
     try:
-        response = requests.get(url, headers=headers)
+        response = await yandex_request('GET', url)
         if response.status_code == 200:
             return response.json().get('href')
         if response.status_code == 401:
             logger.error(f"401 Unauthorized для файла {file_path}. Проверьте YANDEX_TOKEN.")
             return None
+        if response.status_code == 404:
+            forget_yandex_folder(file_path.rsplit('/', 1)[0])
         logger.error(f"Ошибка Яндекс.Диска для файла {file_path}: код {response.status_code}, ответ: {response.text}")
         return None
     except Exception as e:
         logger.error(f"Ошибка при запросе к Яндекс.Диску для файла {file_path}: {str(e)}")
         return None
 
-def upload_to_yandex_disk(file_content: bytes, file_name: str, folder_path: str) -> bool:
-    """Загружает файл на Яндекс.Диск."""
+async def read_file_chunks(local_path: str, progress: ProgressCallback | None = None) -> AsyncIterator[bytes]:
+    """Читает локальный файл блоками TRANSFER_CHUNK_SIZE, не блокируя event loop."""
+    total = os.path.getsize(local_path)
+    done = 0
+    with open(local_path, 'rb') as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, TRANSFER_CHUNK_SIZE)
+            if not chunk:
+                break
+            done += len(chunk)
+            yield chunk
+            if progress is not None:
+                await progress(done, total)
+
+async def upload_to_yandex_disk(local_path: str, file_name: str, folder_path: str,
+                                progress: ProgressCallback | None = None) -> bool:
+    """Загружает локальный файл на Яндекс.Диск потоково.
+
+    При сетевых сбоях и ответах 429/5xx PUT повторяется с новой ссылкой для загрузки
+    (до UPLOAD_RETRIES попыток); файл читается заново с локального диска.
+    """
     folder_path = folder_path.rstrip('/')
     file_path = f"{folder_path}/{file_name}"
     encoded_path = quote(file_path, safe='/')
     url = f'https://cloud-api.yandex.net/v1/disk/resources/upload?path={encoded_path}&overwrite=true'
-    headers = {'Authorization': f'OAuth {YANDEX_TOKEN}'}
-    try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            upload_url = response.json().get('href')
-            if upload_url:
-                upload_response = requests.put(upload_url, data=file_content)
+    file_size = os.path.getsize(local_path)
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            response = await yandex_request('GET', url)
+            if response.status_code == 200:
+                upload_url = response.json().get('href')
+                if not upload_url:
+                    logger.error(f"Не получен URL для загрузки файла {file_path}")
+                    return False
+                upload_response = await yandex_request('PUT', upload_url, auth=False,
+                                                       content=read_file_chunks(local_path, progress),
+                                                       headers={'Content-Length': str(file_size)})
                 if upload_response.status_code in (201, 202):
                     logger.info(f"Файл {file_name} загружен в {folder_path}")
+                    LISTING_CACHE.invalidate(normalize_disk_path(folder_path))
                     return True
                 if upload_response.status_code == 401:
                     logger.error(f"401 Unauthorized при загрузке {file_path}. Проверьте YANDEX_TOKEN.")
                     return False
+                if upload_response.status_code != 429 and upload_response.status_code < 500:
+                    logger.error(
+                        f"Ошибка загрузки файла {file_path}: код {upload_response.status_code}, ответ: {upload_response.text}")
+                    return False
+                logger.warning(f"Попытка {attempt} загрузки {file_path} не удалась: код {upload_response.status_code}")
+            elif response.status_code == 401:
+                logger.error(f"401 Unauthorized при получении URL для {file_path}. Проверьте YANDEX_TOKEN.")
+                return False
+            elif response.status_code != 429 and response.status_code < 500:
+                if response.status_code in (404, 409):
+                    # 409 DiskPathDoesntExistsError: папки назначения больше нет
+                    forget_yandex_folder(folder_path)
                 logger.error(
-                    f"Ошибка загрузки файла {file_path}: код {upload_response.status_code}, ответ: {upload_response.text}")
+                    f"Ошибка получения URL для загрузки {file_path}: код {response.status_code}, ответ: {response.text}")
                 return False
-            logger.error(f"Не получен URL для загрузки файла {file_path}")
-            return False
-        if response.status_code == 401:
-            logger.error(f"401 Unauthorized при получении URL для {file_path}. Проверьте YANDEX_TOKEN.")
+            else:
+                logger.warning(f"Попытка {attempt} получить URL для {file_path} не удалась: код {response.status_code}")
+        except httpx.TransportError as e:
+            logger.warning(f"Попытка {attempt} загрузки {file_path} прервана: {str(e)}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке файла {file_path}: {str(e)}")
             return False
-        logger.error(
-            f"Ошибка получения URL для загрузки {file_path}: код {response.status_code}, ответ: {response.text}")
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке файла {file_path}: {str(e)}")
-        return False
+        if attempt < UPLOAD_RETRIES:
+            await asyncio.sleep(2 ** attempt)
+    logger.error(f"Не удалось загрузить {file_path} за {UPLOAD_RETRIES} попыток.")
+    return False
 
-def delete_yandex_disk_file(file_path: str) -> bool:
+async def delete_yandex_disk_file(file_path: str) -> bool:
     """Удаляет файл с Яндекс.Диска."""
     file_path = file_path.rstrip('/')
     encoded_path = quote(file_path, safe='/')
     url = f'https://cloud-api.yandex.net/v1/disk/resources?path={encoded_path}'
-    headers = {'Authorization': f'OAuth {YANDEX_TOKEN}'}
     try:
-        response = requests.delete(url, headers=headers)
+        response = await yandex_request('DELETE', url)
         if response.status_code in (204, 202):
             logger.info(f"Файл {file_path} удалён.")
+            LISTING_CACHE.invalidate(normalize_disk_path(file_path.rsplit('/', 1)[0]))
             return True
         if response.status_code == 401:
             logger.error(f"401 Unauthorized при удалении {file_path}. Проверьте YANDEX_TOKEN.")
             return False
+        if response.status_code == 404:
+            forget_yandex_folder(file_path.rsplit('/', 1)[0])
         logger.error(f"Ошибка удаления файла {file_path}: код {response.status_code}, ответ: {response.text}")
         return False
     except Exception as e:
         logger.error(f"Ошибка при удалении файла {file_path}: {str(e)}")
         return False
 
+async def warm_yandex_folder_cache(root_path: str, recursive: bool = False) -> None:
+    """Заполняет кэш существующих папок содержимым дерева root_path."""
+    pending = [root_path.rstrip('/')]
+    count = 0
+    while pending:
+        folder_path = pending.pop()
+        for dir_name in await list_yandex_disk_directories(folder_path):
+            count += 1
+            if recursive:
+                pending.append(f"{folder_path}/{dir_name}")
+    logger.info(f"Кэш папок прогрет для {root_path}: {count} папок.")
+
 # Функция веб-поиска
-def web_search(query: str) -> str:
-    """Выполняет поиск в интернете и кэширует результаты."""
-    cache_file = 'search_cache.json'
-    try:
-        if not os.path.exists(cache_file):
-            logger.warning("Файл search_cache.json не найден, создаётся новый.")
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False)
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            cache = json.load(f)
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке search_cache.json: {str(e)}")
-        cache = {}
-    if query in cache:
-        logger.info(f"Использую кэш для запроса: {query}")
-        return cache[query]
+SEARCH_CACHE_DB = os.getenv("SEARCH_CACHE_DB", "search_cache.db")  # Файл SQLite с кэшем результатов поиска
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(24 * 3600)))  # Сколько секунд результаты поиска считаются актуальными
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))  # Максимум запросов в кэше поиска
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "15"))  # Таймаут одного веб-поиска, секунды
+
+# Тематические фразы: их результаты поиска заранее загружаются в кэш и поддерживаются свежими
+SEARCH_PREFETCH_QUERIES = ["вскс", "спасатели", "корпус спасателей"]
+# Фразы, при которых к ответу ИИ подключается веб-поиск
+SEARCH_TRIGGERS = [
+    "актуальная информация", "последние новости", "найди в интернете", "поиск",
+    "что такое", "информация о", "расскажи о", "найди", "поиск по", "детали о",
+    *SEARCH_PREFETCH_QUERIES
+]
+
+_inflight_searches: Dict[str, asyncio.Task] = {}  # Нормализованный запрос -> выполняющийся поиск
+
+def normalize_query(query: str) -> str:
+    """Нормализует поисковый запрос для использования в качестве ключа кэша."""
+    query = query.lower().replace('ё', 'е')
+    query = re.sub(r'[^\w\s]', ' ', query)
+    return ' '.join(query.split())
+
+class SearchCache:
+    """Кэш результатов веб-поиска в SQLite.
+
+    Ключ — нормализованный запрос (поиск по первичному ключу без чтения всего кэша),
+    записи старше ttl не используются, при превышении max_entries вытесняются
+    давно не запрашивавшиеся.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    key TEXT PRIMARY KEY,
+                    results TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS search_cache_accessed ON search_cache (accessed_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS search_cache_created ON search_cache (created_at)")
+            self._size = self._conn.execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+
+    def get(self, query: str) -> str | None:
+        """Возвращает сохранённые результаты для запроса или None."""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT results, created_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now - self.ttl:
+                self._conn.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+                self._size -= 1
+                return None
+            self._conn.execute("UPDATE search_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def put(self, query: str, results: str) -> None:
+        """Сохраняет результаты поиска, вытесняя устаревшие и давно не использованные записи."""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock, self._conn:
+            existed = self._conn.execute("SELECT 1 FROM search_cache WHERE key = ?", (key,)).fetchone() is not None
+            self._conn.execute(
+                "INSERT OR REPLACE INTO search_cache (key, results, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, results, now, now))
+            if not existed:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._size -= self._conn.execute("DELETE FROM search_cache WHERE created_at < ?",
+                                                 (now - self.ttl,)).rowcount
+            if self._size > self.max_entries:
+                self._size -= self._conn.execute(
+                    "DELETE FROM search_cache WHERE key IN "
+                    "(SELECT key FROM search_cache ORDER BY accessed_at LIMIT ?)",
+                    (self._size - self.max_entries,)).rowcount
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_DB, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+def run_ddgs_search(query: str) -> str:
+    """Выполняет поиск DuckDuckGo (блокирующий вызов, запускается в отдельном потоке)."""
+    with DDGS() as ddgs:
+        results = [r for r in ddgs.text(query, max_results=3)]
+    return json.dumps(results, ensure_ascii=False, indent=2)
+
+async def search_and_cache(query: str) -> str:
+    """Выполняет поиск вне event loop с таймаутом и сохраняет результат в кэш."""
     try:
-        with DDGS() as ddgs:
-            results = [r for r in ddgs.text(query, max_results=3)]
-        search_results = json.dumps(results, ensure_ascii=False, indent=2)
-        cache[query] = search_results
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        search_results = await asyncio.wait_for(asyncio.to_thread(run_ddgs_search, query), SEARCH_TIMEOUT)
+        await asyncio.to_thread(SEARCH_CACHE.put, query, search_results)
         logger.info(f"Поиск выполнен для запроса: {query}")
         return search_results
+    except asyncio.TimeoutError:
+        logger.error(f"Поиск по запросу '{query}' не уложился в {SEARCH_TIMEOUT} с.")
+        return json.dumps({"error": "Не удалось выполнить поиск."}, ensure_ascii=False)
     except Exception as e:
         logger.error(f"Ошибка при поиске: {str(e)}")
         return json.dumps({"error": "Не удалось выполнить поиск."}, ensure_ascii=False)
 
+async def web_search(query: str, refresh: bool = False) -> str:
+    """Выполняет поиск в интернете и кэширует результаты.
+
+    Одинаковые (после нормализации) запросы, пришедшие одновременно, ждут один и тот же поиск.
+    """
+    if not refresh:
+        cached = await asyncio.to_thread(SEARCH_CACHE.get, query)
+        if cached is not None:
+            logger.info(f"Использую кэш для запроса: {query}")
+            return cached
+    key = normalize_query(query)
+    task = _inflight_searches.get(key)
+    if task is None:
+        task = asyncio.create_task(search_and_cache(query))
+        _inflight_searches[key] = task
+        task.add_done_callback(lambda _: _inflight_searches.pop(key, None))
+    else:
+        logger.info(f"Запрос '{query}' уже выполняется, ожидаю его результат.")
+    return await asyncio.shield(task)
+
+def search_query_for(question: str) -> str:
+    """Подбирает поисковый запрос для вопроса.
+
+    Если в вопросе есть тематическая фраза, ищем по ней: её результаты уже лежат в кэше,
+    и вопросы вроде «расскажи про вскс» не запускают отдельный поиск в DuckDuckGo.
+    """
+    lowered = question.lower().replace('ё', 'е')
+    for phrase in sorted(SEARCH_PREFETCH_QUERIES, key=len, reverse=True):
+        if phrase in lowered:
+            return phrase
+    return question
+
+async def prefetch_searches() -> None:
+    """Держит в кэше свежие результаты поиска по тематическим фразам."""
+    while True:
+        for query in SEARCH_PREFETCH_QUERIES:
+            await web_search(query, refresh=True)
+        await asyncio.sleep(SEARCH_CACHE_TTL / 2)
+
 # Обработчик команды /learn
 async def handle_learn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка команды /learn для добавления знаний."""
@@ -419,6 +1860,8 @@ async def handle_learn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     fact = ' '.join(context.args)
     global KNOWLEDGE_BASE
     KNOWLEDGE_BASE = add_knowledge(fact, KNOWLEDGE_BASE)
+    KNOWLEDGE_INDEX.add(fact.strip())
+    ANSWER_CACHE.clear()
     save_knowledge_base(KNOWLEDGE_BASE)
     await update.message.reply_text(f"Факт добавлен: '{fact}'. Теперь бот использует его во всех ответах!")
     logger.info(f"Администратор {user_id} добавил факт: {fact}")
@@ -440,6 +1883,8 @@ async def handle_forget(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     global KNOWLEDGE_BASE
     if fact in KNOWLEDGE_BASE:
         KNOWLEDGE_BASE = remove_knowledge(fact, KNOWLEDGE_BASE)
+        KNOWLEDGE_INDEX.remove(fact.strip())
+        ANSWER_CACHE.clear()
         save_knowledge_base(KNOWLEDGE_BASE)
         await update.message.reply_text(f"Факт удалён: '{fact}'.")
         logger.info(f"Администратор {user_id} удалил факт: {fact}")
@@ -462,7 +1907,7 @@ async def send_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     context.user_data.clear()
 
     # Проверка доступа
-    if user_id not in ALLOWED_USERS and user_id not in ALLOWED_ADMINS:
+    if not has_access(user_id):
         welcome_message = f"Ваш user_id: {user_id}\nИзвините, у вас нет доступа. Передайте user_id администратору."
         await update.message.reply_text(welcome_message, reply_markup=ReplyKeyboardRemove())
         logger.info(f"Пользователь {user_id} попытался получить доступ.")
@@ -488,14 +1933,7 @@ async def send_welcome(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает главное меню с командами."""
     user_id: int = update.effective_user.id
-    admin_keyboard = [
-        ['Управление пользователями', 'Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ] if user_id in ALLOWED_ADMINS else [
-        ['Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ]
-    reply_markup = ReplyKeyboardMarkup(admin_keyboard, resize_keyboard=True)
+    reply_markup = main_menu_markup(user_id)
     context.user_data['default_reply_markup'] = reply_markup
     context.user_data.pop('current_mode', None)
     context.user_data.pop('current_dir', None)
@@ -514,7 +1952,7 @@ async def get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id: int = update.effective_user.id
     chat_id: int = update.effective_chat.id
 
-    if user_id not in ALLOWED_USERS and user_id not in ALLOWED_ADMINS:
+    if not has_access(user_id):
         await update.message.reply_text("Извините, у вас нет доступа.", reply_markup=ReplyKeyboardRemove())
         logger.info(f"Пользователь {user_id} попытался скачать файл.")
         return
@@ -530,6 +1968,170 @@ async def get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     file_name = ' '.join(context.args).strip()
     await search_and_send_file(update, context, file_name)
 
+# Передача файлов с Яндекс.Диска в Telegram
+def file_version(file_info: Dict[str, Any] | None) -> str | None:
+    """Возвращает идентификатор версии файла на Диске (md5, иначе время изменения)."""
+    if not file_info:
+        return None
+    return file_info.get('md5') or file_info.get('modified')
+
+def get_cached_file_id(file_path: str, version: str | None) -> str | None:
+    """Возвращает file_id, под которым эта версия файла уже отправлялась в Telegram."""
+    if version is None:
+        return None
+    entry = FILE_ID_CACHE.get(normalize_disk_path(file_path))
+    if entry and entry.get('version') == version:
+        return entry.get('file_id')
+    return None
+
+def remember_file_id(file_path: str, version: str, file_id: str) -> None:
+    """Запоминает file_id отправленной версии файла."""
+    FILE_ID_CACHE[normalize_disk_path(file_path)] = {'version': version, 'file_id': file_id}
+    save_file_id_cache(FILE_ID_CACHE)
+
+def forget_file_id(file_path: str) -> None:
+    """Удаляет file_id файла из кэша (например, если Telegram его больше не принимает)."""
+    if FILE_ID_CACHE.pop(normalize_disk_path(file_path), None) is not None:
+        save_file_id_cache(FILE_ID_CACHE)
+
+_file_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()  # md5 -> блокировка отправки этой версии файла
+
+def cached_file_path(md5: str) -> str:
+    """Путь к содержимому файла в локальном кэше."""
+    return os.path.join(FILE_CACHE_DIR, md5)
+
+def evict_file_cache() -> None:
+    """Удаляет давно не использованные файлы, пока кэш не уложится в FILE_CACHE_MAX_MB."""
+    try:
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(FILE_CACHE_DIR)
+                         if entry.is_file() and not entry.name.endswith('.part'))
+    except FileNotFoundError:
+        return
+    total = sum(size for _, size, _ in entries)
+    max_bytes = FILE_CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"Не удалось удалить {path} из кэша файлов: {str(e)}")
+            continue
+        total -= size
+        logger.info(f"Файл {path} вытеснен из локального кэша.")
+
+async def send_yandex_disk_file(message: Message, file_path: str, file_name: str,
+                                file_info: Dict[str, Any] | None = None, reply_markup: Any = None) -> bool:
+    """Отправляет файл с Яндекс.Диска в Telegram.
+
+    Если эта версия файла (md5 из списка папки) уже отправлялась, повторно используется её file_id,
+    и Диск не запрашивается вовсе. Иначе содержимое берётся из локального кэша по md5 или скачивается
+    потоково: размер проверяется до скачивания по метаданным Диска или по заголовку Content-Length,
+    блоки пишутся в файл кэша (или во временный буфер, если md5 неизвестен).
+    """
+    global _transfer_semaphore
+    max_bytes = TELEGRAM_SEND_LIMIT_MB * 1024 * 1024
+    version = file_version(file_info)
+    md5 = (file_info or {}).get('md5')
+
+    async def reject_too_large(file_size: int) -> bool:
+        await message.reply_text(f"Файл слишком большой (>{TELEGRAM_SEND_LIMIT_MB} МБ).", reply_markup=reply_markup)
+        logger.error(f"Файл {file_name} слишком большой: {file_size / (1024 * 1024):.1f} МБ")
+        return False
+
+    size = (file_info or {}).get('size')
+    if size is not None and size > max_bytes:
+        return await reject_too_large(size)
+
+    async def send_and_remember(document: Any) -> bool:
+        sent = await message.reply_document(document=document, filename=file_name)
+        if version is not None and sent.document is not None:
+            remember_file_id(file_path, version, sent.document.file_id)
+        return True
+
+    async def send_from_cache() -> bool:
+        path = cached_file_path(md5)
+        os.utime(path)
+        with open(path, 'rb') as cached:
+            await send_and_remember(cached)
+        # Содержимое больше не нужно: дальше файл отправляется по file_id
+        os.remove(path)
+        return True
+
+    # Одновременные отправки одной версии файла выполняются по очереди: первая скачивает файл
+    # в собственный .part и запоминает file_id, остальные отправляют его по file_id, не скачивая заново
+    file_lock = _file_locks.setdefault(md5, asyncio.Lock()) if md5 else contextlib.nullcontext()
+    async with file_lock:
+        cached_file_id = get_cached_file_id(file_path, version)
+        if cached_file_id:
+            try:
+                await message.reply_document(document=cached_file_id, filename=file_name)
+                logger.info(f"Файл {file_name} отправлен по сохранённому file_id.")
+                return True
+            except BadRequest as e:
+                logger.warning(f"Telegram не принял сохранённый file_id для {file_path}: {str(e)}")
+                forget_file_id(file_path)
+        part_path = None
+        if _transfer_semaphore is None:
+            _transfer_semaphore = asyncio.Semaphore(TRANSFER_MAX_CONCURRENCY)
+        async with _transfer_semaphore:
+            try:
+                if md5 and os.path.exists(cached_file_path(md5)):
+                    return await send_from_cache()
+
+                download_url = await get_yandex_disk_file(file_path)
+                if not download_url:
+                    await message.reply_text("Ошибка: не удалось получить ссылку для скачивания (проверьте токен Яндекс.Диска).",
+                                             reply_markup=reply_markup)
+                    logger.error(f"Не удалось получить ссылку для файла {file_path}.")
+                    return False
+
+                if md5:
+                    os.makedirs(FILE_CACHE_DIR, exist_ok=True)
+                    fd, part_path = tempfile.mkstemp(prefix=f"{md5}.", suffix='.part', dir=FILE_CACHE_DIR)
+                    buffer = os.fdopen(fd, 'w+b')
+                else:
+                    buffer = tempfile.SpooledTemporaryFile(max_size=TRANSFER_SPOOL_SIZE)
+                with buffer:
+                    async with get_disk_download_client().stream('GET', download_url) as response:
+                        if response.status_code != 200:
+                            await response.aread()
+                            await message.reply_text("Не удалось загрузить файл с Яндекс.Диска.", reply_markup=reply_markup)
+                            logger.error(
+                                f"Ошибка загрузки файла {file_path}: код {response.status_code}, ответ: {response.text}")
+                            return False
+                        content_length = int(response.headers.get('Content-Length') or 0)
+                        if content_length > max_bytes:
+                            return await reject_too_large(content_length)
+                        received = 0
+                        async for chunk in response.aiter_bytes(TRANSFER_CHUNK_SIZE):
+                            received += len(chunk)
+                            if received > max_bytes:
+                                return await reject_too_large(received)
+                            buffer.write(chunk)
+                        # Content-Length сжатого ответа не совпадает с размером файла, поэтому сверяем только несжатый
+                        expected = size if size is not None else \
+                            (content_length or None if 'Content-Encoding' not in response.headers else None)
+                    if expected is not None and received != expected:
+                        raise IOError(f"получено {received} байт из {expected}")
+                    if not md5:
+                        buffer.seek(0)
+                        return await send_and_remember(buffer)
+                os.replace(part_path, cached_file_path(md5))
+                part_path = None
+                try:
+                    return await send_from_cache()
+                finally:
+                    await asyncio.to_thread(evict_file_cache)
+            except Exception as e:
+                await message.reply_text(f"Ошибка при отправке файла: {str(e)}", reply_markup=reply_markup)
+                logger.error(f"Ошибка при отправке файла {file_path}: {str(e)}")
+                return False
+            finally:
+                if part_path is not None and os.path.exists(part_path):
+                    os.remove(part_path)
+
 # Поиск и отправка файла из региона
 async def search_and_send_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_name: str) -> None:
     """Ищет и отправляет файл с Яндекс.Диска из региональной папки."""
@@ -541,50 +2143,203 @@ async def search_and_send_file(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     region_folder = f"/regions/{profile['region']}/"
-    if not create_yandex_folder(region_folder):
+    if not await create_yandex_folder(region_folder):
         await update.message.reply_text("Ошибка: не удалось проверить или создать папку региона (проверьте токен Яндекс.Диска).")
         logger.error(f"Не удалось создать папку {region_folder} для пользователя {user_id}.")
         return
 
-    if not file_name.lower().endswith(('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.cdr', '.eps', '.png', '.jpg', '.jpeg')):
+    if not file_name.lower().endswith(SUPPORTED_EXTENSIONS):
         await update.message.reply_text("Поддерживаются только файлы .pdf, .doc, .docx, .xls, .xlsx, .cdr, .eps, .png, .jpg, .jpeg.")
         logger.error(f"Неподдерживаемый формат файла {file_name} для пользователя {user_id}.")
         return
 
-    files = list_yandex_disk_files(region_folder)
-    matching_file = next((item for item in files if item['name'].lower() == file_name.lower()), None)
+    matching_file = None
+    async for item in iter_yandex_disk_items(region_folder, item_type='file'):
+        if item['name'].lower() == file_name.lower():
+            matching_file = item
+            break
 
     if not matching_file:
         await update.message.reply_text(f"Файл '{file_name}' не найден в папке {region_folder}.")
         logger.info(f"Файл '{file_name}' не найден для пользователя {user_id}.")
         return
 
-    file_path = matching_file['path']
-    download_url = get_yandex_disk_file(file_path)
-    if not download_url:
-        await update.message.reply_text("Ошибка: не удалось получить ссылку для скачивания (проверьте токен Яндекс.Диска).")
-        logger.error(f"Не удалось получить ссылку для файла {file_path}.")
-        return
+    if await send_yandex_disk_file(update.message, matching_file['path'], file_name, matching_file):
+        logger.info(f"Файл {file_name} отправлен пользователю {user_id}.")
+
+# Перенос загруженных пользователями документов из Telegram на Яндекс.Диск
+def make_progress_reporter(status_message: Message, label: str) -> ProgressCallback:
+    """Возвращает callback, который показывает ход передачи, редактируя сообщение о статусе."""
+    last = {'time': 0.0, 'percent': -1}
 
+    async def report(done: int, total: int) -> None:
+        percent = int(done * 100 / total) if total else 100
+        now = time.monotonic()
+        if percent == last['percent'] or (percent < 100 and now - last['time'] < PROGRESS_EDIT_INTERVAL):
+            return
+        last.update(time=now, percent=percent)
+        try:
+            await status_message.edit_text(f"{label}: {percent}%")
+        except Exception as e:
+            logger.warning(f"Не удалось обновить статус загрузки: {str(e)}")
+
+    return report
+
+async def download_telegram_file(bot: Any, file_id: str, local_path: str, file_size: int,
+                                 progress: ProgressCallback | None = None) -> None:
+    """Скачивает файл из Telegram в локальный файл блоками, не держа его целиком в памяти."""
+    file = await bot.get_file(file_id)
+    if not urlparse(file.file_path).scheme:
+        # Локальный Bot API сервер отдаёт путь к файлу на диске
+        await file.download_to_drive(local_path)
+        return
+    done = 0
+    with open(local_path, 'wb') as f:
+        async with get_telegram_files_client().stream('GET', file.file_path) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(TRANSFER_CHUNK_SIZE):
+                await asyncio.to_thread(f.write, chunk)
+                done += len(chunk)
+                if progress is not None:
+                    await progress(done, file_size)
+
+async def transfer_telegram_file_to_disk(bot: Any, file_id: str, file_name: str, file_size: int,
+                                         folder_path: str, status_message: Message) -> bool:
+    """Скачивает документ из Telegram во временный файл и загружает его на Яндекс.Диск.
+
+    Временный файл позволяет повторить загрузку на Диск без повторного скачивания из Telegram.
+    """
+    fd, local_path = tempfile.mkstemp(prefix='upload_', suffix=os.path.splitext(file_name)[1])
+    os.close(fd)
     try:
-        file_response = requests.get(download_url)
-        if file_response.status_code == 200:
-            file_size = len(file_response.content) / (1024 * 1024)
-            if file_size > 20:
-                await update.message.reply_text("Файл слишком большой (>20 МБ).")
-                logger.error(f"Файл {file_name} слишком большой: {file_size} МБ")
-                return
-            await update.message.reply_document(
-                document=InputFile(file_response.content, filename=file_name)
-            )
-            logger.info(f"Файл {file_name} отправлен пользователю {user_id}.")
+        await download_telegram_file(bot, file_id, local_path, file_size,
+                                     make_progress_reporter(status_message, "Получение файла"))
+        return await upload_to_yandex_disk(local_path, file_name, folder_path,
+                                           make_progress_reporter(status_message, "Загрузка на Яндекс.Диск"))
+    finally:
+        os.remove(local_path)
+
+class UploadQueue:
+    """Очередь загрузок на Яндекс.Диск с ограниченным пулом обработчиков.
+
+    Задачи группируются по папке региона, и обработчики берут их из регионов по кругу,
+    поэтому один регион с десятком файлов не задерживает остальные.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.active = 0
+        self._queues: Dict[str, deque] = {}
+        self._regions: deque = deque()  # Регионы с ожидающими задачами в порядке обхода
+        self._pending: asyncio.Semaphore | None = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[asyncio.Task, Dict[str, Any]] = {}  # Обработчик -> выполняемая им задача
+        self._bot: Any = None
+        self._avg_duration: float | None = None  # Скользящее среднее времени одной загрузки, секунды
+
+    @property
+    def depth(self) -> int:
+        """Число задач, ожидающих обработки."""
+        return sum(len(jobs) for jobs in self._queues.values())
+
+    def eta(self) -> float | None:
+        """Оценка времени (в секундах), через которое освободится очередь."""
+        if self._avg_duration is None:
+            return None
+        rounds = -(-(self.depth + self.active) // self.workers)
+        return rounds * self._avg_duration
+
+    def start(self, bot: Any) -> None:
+        """Запускает обработчики очереди."""
+        self._bot = bot
+        self._pending = asyncio.Semaphore(0)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Очередь загрузок запущена: {self.workers} обработчиков.")
+
+    async def stop(self, timeout: float) -> None:
+        """Дожидается очереди не дольше timeout секунд, затем прерывает оставшиеся загрузки и сообщает о них авторам."""
+        deadline = time.monotonic() + timeout
+        if self._tasks and (self.depth or self.active):
+            logger.info(f"Остановка: дожидаемся загрузок на Диск ({self.active} выполняется, {self.depth} в очереди)...")
+        while self._tasks and (self.depth or self.active) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        unfinished = list(self._running.values())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._running.clear()
+        while self._regions:
+            unfinished.append(self._next_job())
+        if unfinished:
+            logger.warning(f"Бот остановлен, не завершено загрузок: {len(unfinished)}")
+            await asyncio.gather(*(self._notify_unfinished(job) for job in unfinished))
+
+    async def _notify_unfinished(self, job: Dict[str, Any]) -> None:
+        """Сообщает автору, что загрузка прервана остановкой бота."""
+        file_name = job['file_name']
+        try:
+            await job['status_message'].edit_text(f"Загрузка файла {file_name} прервана: бот перезапускается.")
+            await self._bot.send_message(job['chat_id'], f"Файл {file_name} не был загружен из-за перезапуска бота. "
+                                                         f"Отправьте его ещё раз через несколько минут.")
+        except Exception as e:
+            logger.error(f"Не удалось сообщить {job['user_id']} о прерванной загрузке {file_name}: {str(e)}")
+
+    def submit(self, job: Dict[str, Any]) -> int:
+        """Ставит загрузку в очередь и возвращает её позицию."""
+        region = job['folder']
+        if region not in self._queues:
+            self._queues[region] = deque()
+            self._regions.append(region)
+        self._queues[region].append(job)
+        self._pending.release()
+        return self.depth
+
+    def _next_job(self) -> Dict[str, Any]:
+        region = self._regions.popleft()
+        jobs = self._queues[region]
+        job = jobs.popleft()
+        if jobs:
+            self._regions.append(region)
         else:
-            await update.message.reply_text("Не удалось загрузить файл с Яндекс.Диска.")
-            logger.error(
-                f"Ошибка загрузки файла {file_path}: код {file_response.status_code}, ответ: {file_response.text}")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка при отправке файла: {str(e)}")
-        logger.error(f"Ошибка при отправке файла {file_path}: {str(e)}")
+            del self._queues[region]
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            await self._pending.acquire()
+            job = self._next_job()
+            self.active += 1
+            self._running[asyncio.current_task()] = job
+            started_at = time.monotonic()
+            try:
+                await self._process(job)
+            except Exception as e:
+                logger.error(f"Ошибка обработки загрузки {job['file_name']} от {job['user_id']}: {str(e)}")
+            finally:
+                self._running.pop(asyncio.current_task(), None)
+                self.active -= 1
+                duration = time.monotonic() - started_at
+                self._avg_duration = duration if self._avg_duration is None else 0.8 * self._avg_duration + 0.2 * duration
+
+    async def _process(self, job: Dict[str, Any]) -> None:
+        status_message = job['status_message']
+        file_name, folder = job['file_name'], job['folder']
+        try:
+            uploaded = await transfer_telegram_file_to_disk(self._bot, job['file_id'], file_name, job['file_size'],
+                                                            folder, status_message)
+        except Exception as e:
+            logger.error(f"Ошибка обработки документа от {job['user_id']}: {str(e)}")
+            uploaded = False
+        if uploaded:
+            await status_message.edit_text(f"Файл {file_name} загружен в папку {folder}")
+            await self._bot.send_message(job['chat_id'], f"Файл {file_name} успешно загружен в папку {folder}")
+            logger.info(f"Пользователь {job['user_id']} загрузил файл {file_name} в {folder}.")
+        else:
+            await status_message.edit_text(f"Ошибка при загрузке файла {file_name} на Яндекс.Диск (проверьте токен).")
+            await self._bot.send_message(job['chat_id'], f"Не удалось загрузить файл {file_name}. Попробуйте ещё раз.")
+
+UPLOAD_QUEUE = UploadQueue(UPLOAD_WORKERS)
 
 # Обработка загруженных документов
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -596,7 +2351,7 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     document = update.message.document
     file_name = document.file_name
-    if not file_name.lower().endswith(('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.cdr', '.eps', '.png', '.jpg', '.jpeg')):
+    if not file_name.lower().endswith(SUPPORTED_EXTENSIONS):
         await update.message.reply_text("Поддерживаются только файлы .pdf, .doc, .docx, .xls, .xlsx, .cdr, .eps, .png, .jpg, .jpeg.")
         return
 
@@ -610,28 +2365,91 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("Ошибка: регион не определён. Обновите профиль с /start.")
         return
     region_folder = f"/regions/{profile['region']}/"
-    if not create_yandex_folder(region_folder):
+    if not await create_yandex_folder(region_folder):
         await update.message.reply_text("Ошибка: не удалось создать папку региона (проверьте токен Яндекс.Диска).")
         logger.error(f"Не удалось создать папку {region_folder} для пользователя {user_id}.")
         return
 
-    try:
-        file = await context.bot.get_file(document.file_id)
-        file_content = await file.download_as_bytearray()
-        if upload_to_yandex_disk(file_content, file_name, region_folder):
-            await update.message.reply_text(f"Файл успешно загружен в папку {region_folder}")
-        else:
-            await update.message.reply_text("Ошибка при загрузке файла на Яндекс.Диск (проверьте токен).")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка при обработке файла: {str(e)}")
-        logger.error(f"Ошибка обработки документа от {user_id}: {str(e)}")
-
+    status_message = await update.message.reply_text("Файл принят, ставлю в очередь на загрузку...")
+    position = UPLOAD_QUEUE.submit({
+        'user_id': user_id,
+        'chat_id': update.effective_chat.id,
+        'file_id': document.file_id,
+        'file_name': file_name,
+        'file_size': document.file_size,
+        'folder': region_folder,
+        'status_message': status_message,
+    })
+    await status_message.edit_text(f"Файл {file_name} в очереди на загрузку (позиция {position}). "
+                                   f"Сообщу, когда он будет загружен.")
     context.user_data.pop('awaiting_upload', None)
-    logger.info(f"Пользователь {user_id} загрузил файл {file_name} в {region_folder}.")
+    logger.info(f"Пользователь {user_id} поставил файл {file_name} в очередь загрузки в {region_folder}.")
+
+# Обработчик команды /uploads
+async def show_upload_queue(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает состояние очереди загрузок на Яндекс.Диск."""
+    user_id: int = update.effective_user.id
+    if not has_access(user_id):
+        await update.message.reply_text("Извините, у вас нет доступа.", reply_markup=ReplyKeyboardRemove())
+        return
+    depth, active = UPLOAD_QUEUE.depth, UPLOAD_QUEUE.active
+    if not depth and not active:
+        await update.message.reply_text("Очередь загрузок пуста.")
+        return
+    text = f"В очереди: {depth}, загружается сейчас: {active}."
+    eta = UPLOAD_QUEUE.eta()
+    if eta is not None:
+        text += f"\nОчередь освободится примерно через {max(1, round(eta / 60))} мин."
+    await update.message.reply_text(text)
+
+# Обработчик команды /stats (только для админов)
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает статистику задержек и ошибок моделей ИИ."""
+    user_id: int = update.effective_user.id
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут просматривать статистику.")
+        return
+    await update.message.reply_text(f"{LLM_ROUTER.describe()}\n\n{LLM_ADMISSION.describe()}\n"
+                                    f"Кэш ответов: {len(ANSWER_CACHE)} вопросов, "
+                                    f"попаданий {ANSWER_CACHE.hits}, промахов {ANSWER_CACHE.misses}")
 
 # Отображение списка файлов (для регионов)
+async def load_file_list_page(region_folder: str, offset: int) -> tuple[List[Dict[str, str]], int] | None:
+    """Загружает одну страницу папки региона: поддерживаемые файлы страницы и общее число элементов."""
+    page = await get_yandex_disk_page(region_folder, offset, FILE_LIST_PAGE_SIZE)
+    if page is None:
+        return None
+    files = [item for item in page['items']
+             if item['type'] == 'file' and item['name'].lower().endswith(SUPPORTED_EXTENSIONS)]
+    return files, page['total']
+
+def build_file_list_markup(files: List[Dict[str, str]], offset: int, total: int,
+                           for_deletion: bool) -> InlineKeyboardMarkup:
+    """Строит inline-клавиатуру страницы файлов с кнопками перехода между страницами."""
+    action = 'delete' if for_deletion else 'download'
+    keyboard = [[InlineKeyboardButton(item['name'], callback_data=f"{action}:{idx}")]
+                for idx, item in enumerate(files)]
+    navigation = []
+    if offset > 0:
+        navigation.append(InlineKeyboardButton("« Назад",
+                                               callback_data=f"files_page:{action}:{max(offset - FILE_LIST_PAGE_SIZE, 0)}"))
+    if offset + FILE_LIST_PAGE_SIZE < total:
+        navigation.append(InlineKeyboardButton("Вперёд »",
+                                               callback_data=f"files_page:{action}:{offset + FILE_LIST_PAGE_SIZE}"))
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard)
+
+def file_list_page_text(offset: int, total: int, for_deletion: bool) -> str:
+    """Возвращает заголовок страницы списка файлов."""
+    action_text = "Выберите файл для удаления:" if for_deletion else "Список всех файлов:"
+    if total <= FILE_LIST_PAGE_SIZE:
+        return action_text
+    pages = (total + FILE_LIST_PAGE_SIZE - 1) // FILE_LIST_PAGE_SIZE
+    return f"{action_text.rstrip(':')} (стр. {offset // FILE_LIST_PAGE_SIZE + 1} из {pages}):"
+
 async def show_file_list(update: Update, context: ContextTypes.DEFAULT_TYPE, for_deletion: bool = False) -> None:
-    """Показывает список файлов в папке региона."""
+    """Показывает первую страницу списка файлов в папке региона."""
     user_id: int = update.effective_user.id
     profile = USER_PROFILES.get(user_id)
     if not profile or "region" not in profile:
@@ -642,15 +2460,16 @@ async def show_file_list(update: Update, context: ContextTypes.DEFAULT_TYPE, for
         return
 
     region_folder = f"/regions/{profile['region']}/"
-    if not create_yandex_folder(region_folder):
+    if not await create_yandex_folder(region_folder):
         await update.message.reply_text("Ошибка: не удалось создать/проверить папку региона (проверьте токен Яндекс.Диска).",
                                         reply_markup=context.user_data.get('default_reply_markup',
                                                                           ReplyKeyboardRemove()))
         logger.error(f"Не удалось создать папку {region_folder} для пользователя {user_id}.")
         return
 
-    files = list_yandex_disk_files(region_folder)
-    if not files:
+    page = await load_file_list_page(region_folder, 0)
+    files, total = page if page is not None else ([], 0)
+    if not files and total <= FILE_LIST_PAGE_SIZE:
         await update.message.reply_text(f"В папке {region_folder} нет файлов.",
                                         reply_markup=context.user_data.get('default_reply_markup',
                                                                           ReplyKeyboardRemove()))
@@ -658,40 +2477,65 @@ async def show_file_list(update: Update, context: ContextTypes.DEFAULT_TYPE, for
         return
 
     context.user_data['file_list'] = files
-    keyboard = []
-    for idx, item in enumerate(files):
-        action = 'delete' if for_deletion else 'download'
-        callback_data = f"{action}:{idx}"
-        keyboard.append([InlineKeyboardButton(item['name'], callback_data=callback_data)])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    action_text = "Выберите файл для удаления:" if for_deletion else "Список всех файлов:"
-    await update.message.reply_text(action_text, reply_markup=reply_markup)
+    context.user_data['file_list_offset'] = 0
+    reply_markup = build_file_list_markup(files, 0, total, for_deletion)
+    await update.message.reply_text(file_list_page_text(0, total, for_deletion), reply_markup=reply_markup)
     logger.info(f"Пользователь {user_id} запросил список файлов в {region_folder}: {[item['name'] for item in files]}")
 
+async def show_file_list_page(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE, region_folder: str,
+                              offset: int, for_deletion: bool) -> None:
+    """Перерисовывает сообщение со списком файлов, показывая страницу с указанным смещением."""
+    page = await load_file_list_page(region_folder, offset)
+    if page is None:
+        await query.message.reply_text("Ошибка: не удалось получить список файлов (проверьте токен Яндекс.Диска).")
+        return
+    files, total = page
+    if offset > 0 and offset >= total:
+        # После удаления последняя страница могла опустеть — показываем предыдущую
+        offset = max((total - 1) // FILE_LIST_PAGE_SIZE * FILE_LIST_PAGE_SIZE, 0)
+        page = await load_file_list_page(region_folder, offset)
+        if page is None:
+            await query.message.reply_text("Ошибка: не удалось получить список файлов (проверьте токен Яндекс.Диска).")
+            return
+        files, total = page
+    context.user_data['file_list'] = files
+    context.user_data['file_list_offset'] = offset
+    if not files and total == 0:
+        await query.edit_message_text(f"В папке {region_folder} нет файлов.")
+        return
+    await query.edit_message_text(file_list_page_text(offset, total, for_deletion),
+                                  reply_markup=build_file_list_markup(files, offset, total, for_deletion))
+    logger.info(f"Пользователь {query.from_user.id} открыл страницу {offset} списка файлов в {region_folder}")
+
 # Отображение содержимого текущей папки в /documents/
+@lru_cache(maxsize=256)
+def documents_folder_markup(dirs: tuple[str, ...], with_back: bool) -> ReplyKeyboardMarkup:
+    """Клавиатура навигации по папке документов; одинаковые наборы подпапок получают один объект."""
+    keyboard = [[dir_name] for dir_name in dirs]
+    if with_back:
+        keyboard.append(['Назад'])
+    keyboard.append(['В главное меню'])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
 async def show_current_docs(update: Update, context: ContextTypes.DEFAULT_TYPE, is_return: bool = False) -> None:
     """Показывает файлы и/или поддиректории в текущей папке в /documents/."""
     user_id: int = update.effective_user.id
     context.user_data.pop('file_list', None)
     current_path = context.user_data.get('current_path', '/documents/')
     folder_name = current_path.rstrip('/').split('/')[-1] or "Документы"
-    if not create_yandex_folder(current_path):
+    if not await create_yandex_folder(current_path):
         await update.message.reply_text(f"Ошибка: не удалось создать папку {current_path} (проверьте токен Яндекс.Диска).",
                                         reply_markup=context.user_data.get('default_reply_markup',
                                                                           ReplyKeyboardRemove()))
         logger.error(f"Не удалось создать папку {current_path} для пользователя {user_id}.")
         return
 
-    files = list_yandex_disk_files(current_path)
-    dirs = list_yandex_disk_directories(current_path)
+    files = await list_yandex_disk_files(current_path)
+    dirs = await list_yandex_disk_directories(current_path)
 
     logger.info(f"Пользователь {user_id} в папке {current_path}, найдено файлов: {len(files)}, папок: {len(dirs)}")
 
-    keyboard = [[dir_name] for dir_name in dirs]
-    if current_path != '/documents/':
-        keyboard.append(['Назад'])
-    keyboard.append(['В главное меню'])
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    reply_markup = documents_folder_markup(tuple(dirs), current_path != '/documents/')
 
     if files:
         context.user_data['file_list'] = files
@@ -734,7 +2578,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         return
 
     region_folder = f"/regions/{profile['region']}/"
-    if not create_yandex_folder(region_folder):
+    if not await create_yandex_folder(region_folder):
         await query.message.reply_text("Ошибка: не удалось создать папку региона (проверьте токен Яндекс.Диска).", reply_markup=default_reply_markup)
         logger.error(f"Не удалось создать папку {region_folder} для пользователя {user_id}.")
         return
@@ -754,7 +2598,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         current_path = context.user_data.get('current_path', '/documents/')
         files = context.user_data.get('file_list', [])
         if not files:
-            files = list_yandex_disk_files(current_path)
+            files = await list_yandex_disk_files(current_path)
             context.user_data['file_list'] = files
             logger.info(f"Перезагружен file_list для {current_path}: {[item['name'] for item in files]}")
         if not files or file_idx >= len(files):
@@ -765,33 +2609,18 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             return
         file_name = files[file_idx]['name']
         file_path = f"{current_path.rstrip('/')}/{file_name}"
-        download_url = get_yandex_disk_file(file_path)
-        if not download_url:
-            await query.message.reply_text("Ошибка: не удалось получить ссылку для скачивания (проверьте токен).",
-                                           reply_markup=default_reply_markup)
-            logger.error(f"Не удалось получить ссылку для файла {file_path}.")
-            return
+        if await send_yandex_disk_file(query.message, file_path, file_name, files[file_idx],
+                                       reply_markup=default_reply_markup):
+            logger.info(f"Файл {file_name} из {current_path} отправлен пользователю {user_id}.")
+        return
 
-        try:
-            file_response = requests.get(download_url)
-            if file_response.status_code == 200:
-                file_size = len(file_response.content) / (1024 * 1024)
-                if file_size > 20:
-                    await query.message.reply_text("Файл слишком большой (>20 МБ).", reply_markup=default_reply_markup)
-                    logger.error(f"Файл {file_name} слишком большой: {file_size} МБ")
-                    return
-                await query.message.reply_document(
-                    document=InputFile(file_response.content, filename=file_name)
-                )
-                logger.info(f"Файл {file_name} из {current_path} отправлен пользователю {user_id}.")
-            else:
-                await query.message.reply_text("Не удалось загрузить файл с Яндекс.Диска.",
-                                               reply_markup=default_reply_markup)
-                logger.error(
-                    f"Ошибка загрузки файла {file_path}: код {file_response.status_code}, ответ: {file_response.text}")
-        except Exception as e:
-            await query.message.reply_text(f"Ошибка при отправке файла: {str(e)}", reply_markup=default_reply_markup)
-            logger.error(f"Ошибка при отправке файла {file_path}: {str(e)}")
+    if query.data.startswith("files_page:"):
+        parts = query.data.split(":")
+        if len(parts) != 3 or parts[1] not in ("download", "delete") or not parts[2].isdigit():
+            await query.message.reply_text("Ошибка: неверный формат запроса.", reply_markup=default_reply_markup)
+            logger.error(f"Неверный формат callback_data: {query.data}")
+            return
+        await show_file_list_page(query, context, region_folder, int(parts[2]), for_deletion=parts[1] == "delete")
         return
 
     if query.data.startswith("download:") or query.data.startswith("delete:"):
@@ -805,7 +2634,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 
         files = context.user_data.get('file_list', [])
         if not files:
-            files = list_yandex_disk_files(region_folder)
+            page = await load_file_list_page(region_folder, context.user_data.get('file_list_offset', 0))
+            files = page[0] if page is not None else []
             context.user_data['file_list'] = files
             logger.info(f"Перезагружен file_list для {region_folder}: {[item['name'] for item in files]}")
         if not files or file_idx >= len(files):
@@ -819,41 +2649,15 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         file_path = f"{region_folder.rstrip('/')}/{file_name}"
 
         if action == "download":
-            if not file_name.lower().endswith(('.pdf', '.doc', '.docx', '.xls', '.xlsx', '.cdr', '.eps', '.png', '.jpg', '.jpeg')):
+            if not file_name.lower().endswith(SUPPORTED_EXTENSIONS):
                 await query.message.reply_text("Поддерживаются только файлы .pdf, .doc, .docx, .xls, .xlsx, .cdr, .eps, .png, .jpg, .jpeg.",
                                                reply_markup=default_reply_markup)
                 logger.error(f"Неподдерживаемый формат файла {file_name} для пользователя {user_id}.")
                 return
 
-            download_url = get_yandex_disk_file(file_path)
-            if not download_url:
-                await query.message.reply_text("Ошибка: не удалось получить ссылку для скачивания (проверьте токен).",
-                                               reply_markup=default_reply_markup)
-                logger.error(f"Не удалось получить ссылку для файла {file_path}.")
-                return
-
-            try:
-                file_response = requests.get(download_url)
-                if file_response.status_code == 200:
-                    file_size = len(file_response.content) / (1024 * 1024)
-                    if file_size > 20:
-                        await query.message.reply_text("Файл слишком большой (>20 МБ).",
-                                                       reply_markup=default_reply_markup)
-                        logger.error(f"Файл {file_name} слишком большой: {file_size} МБ")
-                        return
-                    await query.message.reply_document(
-                        document=InputFile(file_response.content, filename=file_name)
-                    )
-                    logger.info(f"Файл {file_name} отправлен пользователю {user_id}.")
-                else:
-                    await query.message.reply_text("Не удалось загрузить файл с Яндекс.Диска.",
-                                                   reply_markup=default_reply_markup)
-                    logger.error(
-                        f"Ошибка загрузки файла {file_path}: код {file_response.status_code}, ответ: {file_response.text}")
-            except Exception as e:
-                await query.message.reply_text(f"Ошибка при отправке файла: {str(e)}",
-                                               reply_markup=default_reply_markup)
-                logger.error(f"Ошибка при отправке файла {file_path}: {str(e)}")
+            if await send_yandex_disk_file(query.message, file_path, file_name, files[file_idx],
+                                           reply_markup=default_reply_markup):
+                logger.info(f"Файл {file_name} отправлен пользователю {user_id}.")
 
         elif action == "delete":
             if user_id not in ALLOWED_ADMINS:
@@ -862,7 +2666,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 logger.info(f"Пользователь {user_id} попытался удалить файл.")
                 return
 
-            if delete_yandex_disk_file(file_path):
+            if await delete_yandex_disk_file(file_path):
                 await query.message.reply_text(f"Файл '{file_name}' удалён из папки {region_folder}.",
                                                reply_markup=default_reply_markup)
                 logger.info(f"Администратор {user_id} удалил файл {file_name}.")
@@ -872,20 +2676,14 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 logger.error(f"Ошибка при удалении файла {file_name} для пользователя {user_id}.")
 
             context.user_data.pop('file_list', None)
-            await show_file_list(update, context, for_deletion=True)
+            await show_file_list_page(query, context, region_folder,
+                                      context.user_data.get('file_list_offset', 0), for_deletion=True)
 
 # Вспомогательная функция для отображения главного меню через callback_query
 async def show_main_menu_with_query(query: Update.callback_query, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает главное меню через callback_query."""
     user_id: int = query.from_user.id
-    admin_keyboard = [
-        ['Управление пользователями', 'Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ] if user_id in ALLOWED_ADMINS else [
-        ['Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ]
-    reply_markup = ReplyKeyboardMarkup(admin_keyboard, resize_keyboard=True)
+    reply_markup = main_menu_markup(user_id)
     context.user_data['default_reply_markup'] = reply_markup
     context.user_data.pop('current_mode', None)
     context.user_data.pop('current_dir', None)
@@ -893,6 +2691,340 @@ async def show_main_menu_with_query(query: Update.callback_query, context: Conte
     context.user_data.pop('current_path', None)
     await query.message.reply_text("Выберите действие:", reply_markup=reply_markup)
 
+# Потоковый вывод ответа ИИ
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Не чаще раза в столько секунд редактируем ответ
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина текста одного сообщения Telegram
+
+class MessageStreamer:
+    """Показывает ответ по мере генерации, редактируя одно сообщение с учётом лимитов Telegram."""
+
+    def __init__(self, message: Message, interval: float = STREAM_EDIT_INTERVAL) -> None:
+        self.message = message
+        self.interval = interval
+        self._shown = message.text or ''
+        self._last_edit = 0.0
+
+    async def update(self, text: str) -> None:
+        """Обновляет сообщение, если с прошлого редактирования прошло не меньше interval секунд."""
+        if time.monotonic() - self._last_edit >= self.interval:
+            await self._edit(text[:TELEGRAM_MESSAGE_LIMIT])
+
+    async def finish(self, text: str) -> None:
+        """Показывает окончательный текст; то, что не помещается в одно сообщение, отправляет следом."""
+        await self._edit(text[:TELEGRAM_MESSAGE_LIMIT])
+        for start in range(TELEGRAM_MESSAGE_LIMIT, len(text), TELEGRAM_MESSAGE_LIMIT):
+            await self.message.reply_text(text[start:start + TELEGRAM_MESSAGE_LIMIT])
+
+    async def _edit(self, text: str) -> None:
+        if not text.strip() or text == self._shown:
+            return
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(text)
+            self._shown = text
+        except Exception as e:
+            logger.warning(f"Не удалось обновить сообщение с ответом: {str(e)}")
+
+# Маршрутизация текстовых сообщений
+MessageRoute = Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]
+
+def main_menu_markup(user_id: int) -> ReplyKeyboardMarkup:
+    """Клавиатура главного меню для пользователя или администратора."""
+    return ADMIN_MENU_MARKUP if user_id in ALLOWED_ADMINS else USER_MENU_MARKUP
+
+def reset_navigation(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выходит из навигации по папкам перед переходом в другой раздел меню."""
+    context.user_data.pop('current_mode', None)
+    context.user_data.pop('current_path', None)
+    context.user_data.pop('file_list', None)
+
+async def open_documents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Открывает раздел «Документы для РО»."""
+    user_id: int = update.effective_user.id
+    context.user_data['current_mode'] = 'documents_nav'
+    context.user_data['current_path'] = '/documents/'
+    context.user_data.pop('file_list', None)
+    if not await create_yandex_folder('/documents/'):
+        await update.message.reply_text("Ошибка: не удалось создать папку /documents/ (проверьте токен).")
+        logger.error(f"Не удалось создать папку /documents/ для пользователя {user_id}.")
+        return
+    await show_current_docs(update, context)
+
+async def open_region_archive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Открывает архив документов региона пользователя."""
+    reset_navigation(context)
+    await show_file_list(update, context)
+
+async def open_user_management(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает меню управления пользователями (только для админов)."""
+    user_id: int = update.effective_user.id
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут управлять пользователями.",
+                                        reply_markup=main_menu_markup(user_id))
+        logger.info(f"Пользователь {user_id} попытался использовать управление пользователями.")
+        return
+    reset_navigation(context)
+    await update.message.reply_text("Выберите действие:", reply_markup=USER_MANAGEMENT_MARKUP)
+    logger.info(f"Администратор {user_id} запросил управление пользователями.")
+
+async def start_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ждёт от пользователя файл для загрузки в папку региона."""
+    user_id: int = update.effective_user.id
+    default_reply_markup = main_menu_markup(user_id)
+    profile = USER_PROFILES.get(user_id)
+    if not profile or "region" not in profile:
+        await update.message.reply_text("Ошибка: регион не определён. Обновите профиль с /start.",
+                                        reply_markup=default_reply_markup)
+        return
+    reset_navigation(context)
+    await update.message.reply_text(
+        "Отправьте файл для загрузки.",
+        reply_markup=default_reply_markup
+    )
+    context.user_data['awaiting_upload'] = True
+    logger.info(f"Пользователь {user_id} начал загрузку файла.")
+
+async def start_file_deletion(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает список файлов региона для удаления (только для админов)."""
+    user_id: int = update.effective_user.id
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут удалять файлы.",
+                                        reply_markup=main_menu_markup(user_id))
+        logger.info(f"Пользователь {user_id} попытался удалить файл.")
+        return
+    context.user_data['awaiting_delete'] = True
+    reset_navigation(context)
+    await show_file_list(update, context, for_deletion=True)
+
+async def request_new_user_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Просит ID пользователя, которому нужно открыть доступ."""
+    user_id: int = update.effective_user.id
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут добавлять пользователей.",
+                                        reply_markup=main_menu_markup(user_id))
+        logger.info(f"Пользователь {user_id} попытался добавить пользователя.")
+        return
+    await update.message.reply_text("Укажите user_id для добавления.",
+                                    reply_markup=main_menu_markup(user_id))
+    context.user_data['awaiting_user_id'] = 'add_user'
+    logger.info(f"Администратор {user_id} запросил добавление пользователя.")
+
+async def request_new_admin_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Просит ID пользователя, которого нужно назначить администратором."""
+    user_id: int = update.effective_user.id
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут назначать администраторов.",
+                                        reply_markup=main_menu_markup(user_id))
+        logger.info(f"Пользователь {user_id} попытался добавить администратора.")
+        return
+    await update.message.reply_text("Укажите user_id для назначения администратором.",
+                                    reply_markup=main_menu_markup(user_id))
+    context.user_data['awaiting_user_id'] = 'add_admin'
+    logger.info(f"Администратор {user_id} запросил добавление администратора.")
+
+async def show_allowed_users(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает список пользователей с доступом (только для админов)."""
+    user_id: int = update.effective_user.id
+    default_reply_markup = main_menu_markup(user_id)
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут просматривать список пользователей.",
+                                        reply_markup=default_reply_markup)
+        logger.info(f"Пользователь {user_id} попытался просмотреть список пользователей.")
+        return
+    if not ALLOWED_USERS:
+        await update.message.reply_text("Список пользователей пуст.", reply_markup=default_reply_markup)
+        return
+    users_list = "\n".join([f"ID: {uid}" for uid in ALLOWED_USERS])
+    await update.message.reply_text(f"Разрешённые пользователи:\n{users_list}", reply_markup=default_reply_markup)
+    logger.info(f"Администратор {user_id} запросил список пользователей.")
+
+async def show_allowed_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает список администраторов (только для админов)."""
+    user_id: int = update.effective_user.id
+    default_reply_markup = main_menu_markup(user_id)
+    if user_id not in ALLOWED_ADMINS:
+        await update.message.reply_text("Только администраторы могут просматривать список администраторов.",
+                                        reply_markup=default_reply_markup)
+        logger.info(f"Пользователь {user_id} попытался просмотреть список администраторов.")
+        return
+    if not ALLOWED_ADMINS:
+        await update.message.reply_text("Список администраторов пуст.", reply_markup=default_reply_markup)
+        return
+    admins_list = "\n".join([f"ID: {uid}" for uid in ALLOWED_ADMINS])
+    await update.message.reply_text(f"Администраторы:\n{admins_list}", reply_markup=default_reply_markup)
+    logger.info(f"Администратор {user_id} запросил список администраторов.")
+
+async def leave_documents(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Возвращает из раздела документов в главное меню."""
+    logger.info(f"Пользователь {update.effective_user.id} вернулся в главное меню из {context.user_data.get('current_path')}")
+    await show_main_menu(update, context)
+
+async def documents_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Поднимается на уровень выше в разделе документов; из корня — в главное меню."""
+    current_path = context.user_data.get('current_path', '/documents/')
+    if current_path == '/documents/':
+        await show_main_menu(update, context)
+        return
+    context.user_data.pop('file_list', None)
+    parts = current_path.rstrip('/').split('/')
+    new_path = '/'.join(parts[:-1]) + '/' if len(parts) > 2 else '/documents/'
+    context.user_data['current_path'] = new_path
+    logger.info(f"Пользователь {update.effective_user.id} вернулся назад в {new_path}")
+    await show_current_docs(update, context, is_return=True)
+
+async def open_documents_folder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Переходит во вложенную папку раздела документов. Возвращает False, если такой папки нет."""
+    user_id: int = update.effective_user.id
+    user_input: str = update.message.text.strip()
+    current_path = context.user_data.get('current_path', '/documents/')
+    logger.info(f"Пользователь {user_id} пытается перейти в папку: {user_input}, текущий путь: {current_path}")
+    if user_input not in await list_yandex_disk_directories(current_path):
+        return False
+    context.user_data.pop('file_list', None)
+    context.user_data['current_path'] = f"{current_path.rstrip('/')}/{user_input}/"
+    logger.info(f"Пользователь {user_id} перешёл в папку: {context.user_data['current_path']}")
+    if not await create_yandex_folder(context.user_data['current_path']):
+        await update.message.reply_text(
+            f"Ошибка: не удалось создать папку {context.user_data['current_path']} (проверьте токен).",
+            reply_markup=main_menu_markup(user_id))
+        logger.error(f"Не удалось создать папку {context.user_data['current_path']} для пользователя {user_id}.")
+        return True
+    await show_current_docs(update, context)
+    return True
+
+async def add_user_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Добавляет пользователя или администратора по присланному ID."""
+    user_id: int = update.effective_user.id
+    default_reply_markup = main_menu_markup(user_id)
+    try:
+        new_id = int(update.message.text.strip())
+    except ValueError:
+        await update.message.reply_text("Ошибка: user_id должен быть числом.", reply_markup=default_reply_markup)
+        logger.error(f"Ошибка: Неверный формат user_id от {user_id}.")
+        return
+    if context.user_data['awaiting_user_id'] == 'add_user':
+        if not ALLOWED_USERS.add(new_id):
+            await update.message.reply_text(f"Пользователь с ID {new_id} уже имеет доступ.",
+                                            reply_markup=default_reply_markup)
+            return
+        await update.message.reply_text(f"Пользователь с ID {new_id} добавлен!",
+                                        reply_markup=default_reply_markup)
+        logger.info(f"Администратор {user_id} добавил пользователя {new_id}.")
+    elif context.user_data['awaiting_user_id'] == 'add_admin':
+        if not ALLOWED_ADMINS.add(new_id):
+            await update.message.reply_text(f"Пользователь с ID {new_id} уже администратор.",
+                                            reply_markup=default_reply_markup)
+            return
+        await update.message.reply_text(f"Пользователь с ID {new_id} назначен администратором!",
+                                        reply_markup=default_reply_markup)
+        logger.info(f"Администратор {user_id} назначил администратора {new_id}.")
+    context.user_data.pop('awaiting_user_id', None)
+
+# Кнопки главного меню и меню управления действуют в любом состоянии
+MENU_ROUTES: Dict[str, MessageRoute] = {
+    "Документы для РО": open_documents,
+    "Архив документов РО": open_region_archive,
+    "Управление пользователями": open_user_management,
+    "Загрузить файл": start_upload,
+    "Удалить файл": start_file_deletion,
+    "Добавить пользователя": request_new_user_id,
+    "Добавить администратора": request_new_admin_id,
+    "Список пользователей": show_allowed_users,
+    "Список администраторов": show_allowed_admins,
+    "Назад": show_main_menu,
+}
+
+# Кнопки, смысл которых зависит от состояния диалога; проверяются раньше MENU_ROUTES
+STATE_ROUTES: Dict[tuple[str, str], MessageRoute] = {
+    ('documents_nav', 'Назад'): documents_back,
+    ('documents_nav', 'В главное меню'): leave_documents,
+}
+
+def conversation_state(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    """Текущее состояние диалога, от которого зависит смысл введённого текста."""
+    if context.user_data.get('awaiting_user_id'):
+        return 'awaiting_user_id'
+    if context.user_data.get('current_mode') == 'documents_nav':
+        return 'documents_nav'
+    return None
+
+# Ответ ИИ на вопрос пользователя
+async def answer_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отвечает на произвольный вопрос: кэш ответов, база знаний, при необходимости поиск и ИИ."""
+    user_id: int = update.effective_user.id
+    chat_id: int = update.effective_chat.id
+    user_input: str = update.message.text.strip()
+    default_reply_markup = main_menu_markup(user_id)
+
+    history = await HISTORY_STORE.get(chat_id)
+    user_name = USER_PROFILES.get(user_id, {}).get("name", "Друг")
+
+    lowered_input = user_input.lower()
+    need_search = any(word in lowered_input for word in SEARCH_TRIGGERS)
+    # Ответы на запросы «найди», «последние новости» и т. п. зависят от времени и не кэшируются;
+    # упоминание темы бота («вскс», «спасатели») само по себе кэширование не отключает
+    cacheable = not any(word in lowered_input for word in SEARCH_TRIGGERS if word not in SEARCH_PREFETCH_QUERIES)
+    # Ответ, построенный по истории разговора, может её пересказывать — другим пользователям его не отдаём
+    has_context = bool(history.turns or history.summary)
+    knowledge_version = KNOWLEDGE_INDEX.version
+    cached_answer = ANSWER_CACHE.get(user_input, knowledge_version) if cacheable else None
+    if cached_answer is not None:
+        logger.info(f"Ответ для user_id {user_id} взят из кэша")
+        history.add("user", user_input)
+        history.add("assistant", cached_answer)
+        await HISTORY_STORE.save(chat_id, history)
+        reply = f"{user_name}, {cached_answer}"
+        for start in range(0, len(reply), TELEGRAM_MESSAGE_LIMIT):
+            await update.message.reply_text(reply[start:start + TELEGRAM_MESSAGE_LIMIT], reply_markup=default_reply_markup)
+        return
+
+    refusal = await LLM_ADMISSION.admit(user_id)
+    if refusal is not None:
+        await update.message.reply_text(refusal, reply_markup=default_reply_markup)
+        return
+
+    relevant_facts = KNOWLEDGE_INDEX.search(user_input, KNOWLEDGE_TOP_K, KNOWLEDGE_TOKEN_BUDGET)
+    if relevant_facts:
+        logger.info(f"Добавлены знания в контекст для user_id {user_id}: {len(relevant_facts)} из {len(KNOWLEDGE_BASE)} фактов")
+
+    search_text = None
+    if need_search:
+        search_query = search_query_for(user_input)
+        logger.info(f"Выполняется поиск для запроса: {search_query}")
+        search_results_json = await web_search(search_query)
+        try:
+            results = json.loads(search_results_json)
+            if isinstance(results, list):
+                search_text = "\n".join(
+                    [f"Источник: {r.get('title', '')}\n{r.get('body', '')}" for r in results if r.get('body')])
+                logger.info(f"Извлечено из поиска: {search_text[:200]}...")
+            else:
+                logger.warning(f"Поиск не дал результатов: {search_results_json}")
+        except json.JSONDecodeError:
+            logger.error(f"Не удалось разобрать результаты поиска: {search_results_json}")
+
+    messages = build_llm_messages(history.turns, user_input, relevant_facts, search_text, history.summary)
+
+    placeholder = await update.message.reply_text(f"{user_name}, …", reply_markup=default_reply_markup)
+    streamer = MessageStreamer(placeholder)
+
+    response_text = "Извините, не удалось получить ответ от HF API. Проверьте HF_TOKEN и модель."
+    try:
+        streamed_text, finished = await LLM_ROUTER.complete(messages, lambda text: streamer.update(f"{user_name}, {text}"))
+        response_text = streamed_text.strip() or response_text
+        logger.info(f"Ответ для user_id {user_id}: {response_text}")
+        # Оборванный на середине ответ показываем спросившему, но не раздаём другим из кэша
+        if finished and streamed_text.strip() and cacheable and not has_context:
+            ANSWER_CACHE.put(user_input, knowledge_version, response_text)
+    except Exception as e:
+        logger.error(f"Ни одна модель не ответила для user_id {user_id}: {str(e)}")
+        response_text = llm_error_text(e)
+
+    history.add("user", user_input)
+    history.add("assistant", response_text)
+    await HISTORY_STORE.save(chat_id, history)
+    await streamer.finish(f"{user_name}, {response_text}")
+
 # Обработка текстовых сообщений
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка текстовых сообщений: регистрация, команды, поиск."""
@@ -906,7 +3038,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_input: str = update.message.text.strip()
     logger.info(f"Получено сообщение от {chat_id} (user_id: {user_id}): {user_input}")
 
-    if user_id not in ALLOWED_USERS and user_id not in ALLOWED_ADMINS:
+    if not has_access(user_id):
         await update.message.reply_text("Извините, у вас нет доступа.", reply_markup=ReplyKeyboardRemove())
         logger.info(f"Пользователь {user_id} попытался отправить сообщение.")
         return
@@ -916,61 +3048,44 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             logger.info(f"Сохранение ФИО для user_id {user_id}: {user_input}")
             USER_PROFILES[user_id] = {"fio": user_input, "name": None, "region": None}
             try:
-                save_user_profiles(USER_PROFILES)
+                await USER_PROFILES.save(user_id)
             except Exception as e:
                 await update.message.reply_text("Ошибка при сохранении профиля. Попробуйте снова.")
                 logger.error(f"Ошибка при сохранении профиля для user_id {user_id}: {str(e)}")
                 return
             context.user_data["awaiting_fio"] = False
             context.user_data["awaiting_federal_district"] = True
-            keyboard = [[district] for district in FEDERAL_DISTRICTS.keys()]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            await update.message.reply_text("Выберите федеральный округ:", reply_markup=reply_markup)
+            await update.message.reply_text("Выберите федеральный округ:", reply_markup=DISTRICT_PICKER_MARKUP)
             return
         else:
             await update.message.reply_text("Сначала пройдите регистрацию с /start.")
             return
 
-    admin_keyboard = [
-        ['Управление пользователями', 'Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ] if user_id in ALLOWED_ADMINS else [
-        ['Загрузить файл'],
-        ['Архив документов РО', 'Документы для РО']
-    ]
-    default_reply_markup = ReplyKeyboardMarkup(admin_keyboard, resize_keyboard=True)
-
     if context.user_data.get("awaiting_federal_district", False):
         if user_input in FEDERAL_DISTRICTS:
             context.user_data["selected_federal_district"] = user_input
             context.user_data["awaiting_federal_district"] = False
             context.user_data["awaiting_region"] = True
-            regions = FEDERAL_DISTRICTS[user_input]
-            keyboard = [[region] for region in regions]
-            reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-            await update.message.reply_text("Выберите регион:", reply_markup=reply_markup)
+            await update.message.reply_text("Выберите регион:", reply_markup=REGION_PICKER_MARKUPS[user_input])
             return
         else:
             await update.message.reply_text("Пожалуйста, выберите из предложенных округов.",
-                                            reply_markup=ReplyKeyboardMarkup(
-                                                [[district] for district in FEDERAL_DISTRICTS.keys()],
-                                                resize_keyboard=True))
+                                            reply_markup=DISTRICT_PICKER_MARKUP)
             return
 
     if context.user_data.get("awaiting_region", False):
         selected_district = context.user_data.get("selected_federal_district")
-        regions = FEDERAL_DISTRICTS.get(selected_district, [])
-        if user_input in regions:
+        if selected_district is not None and REGION_TO_DISTRICT.get(user_input) == selected_district:
             logger.info(f"Сохранение региона для user_id {user_id}: {user_input}")
             USER_PROFILES[user_id]["region"] = user_input
             try:
-                save_user_profiles(USER_PROFILES)
+                await USER_PROFILES.save(user_id)
             except Exception as e:
                 await update.message.reply_text("Ошибка при сохранении региона. Попробуйте снова.")
                 logger.error(f"Ошибка при сохранении региона для user_id {user_id}: {str(e)}")
                 return
             region_folder = f"/regions/{user_input}/"
-            if not create_yandex_folder(region_folder):
+            if not await create_yandex_folder(region_folder):
                 await update.message.reply_text("Ошибка: не удалось создать папку региона (проверьте токен Яндекс.Диска).")
                 logger.error(f"Не удалось создать папку {region_folder} для пользователя {user_id}.")
                 return
@@ -983,8 +3098,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return
         else:
             await update.message.reply_text("Пожалуйста, выберите из предложенных регионов.",
-                                            reply_markup=ReplyKeyboardMarkup([[region] for region in regions],
-                                                                             resize_keyboard=True))
+                                            reply_markup=REGION_PICKER_MARKUPS.get(selected_district, DISTRICT_PICKER_MARKUP))
             return
 
     if context.user_data.get("awaiting_name", False):
@@ -992,7 +3106,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         profile = USER_PROFILES[user_id]
         profile["name"] = user_input
         try:
-            save_user_profiles(USER_PROFILES)
+            await USER_PROFILES.save(user_id)
         except Exception as e:
             await update.message.reply_text("Ошибка при сохранении имени. Попробуйте снова.")
             logger.error(f"Ошибка при сохранении имени для user_id {user_id}: {str(e)}")
@@ -1007,301 +3121,327 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.info(f"Имя пользователя {chat_id} сохранено: {user_input}")
         return
 
-    handled = False
+    state = conversation_state(context)
+    route = STATE_ROUTES.get((state, user_input)) or MENU_ROUTES.get(user_input)
+    if route is not None:
+        context.user_data.pop('awaiting_user_id', None)
+        await route(update, context)
+        return
+    if state == 'awaiting_user_id':
+        await add_user_by_id(update, context)
+        return
+    if state == 'documents_nav' and await open_documents_folder(update, context):
+        return
+    await answer_question(update, context)
 
-    if user_input == "Документы для РО":
-        context.user_data['current_mode'] = 'documents_nav'
-        context.user_data['current_path'] = '/documents/'
-        context.user_data.pop('file_list', None)
-        if not create_yandex_folder('/documents/'):
-            await update.message.reply_text("Ошибка: не удалось создать папку /documents/ (проверьте токен).")
-            logger.error(f"Не удалось создать папку /documents/ для пользователя {user_id}.")
-            return
-        await show_current_docs(update, context)
-        handled = True
-
-    if user_input == "Архив документов РО":
-        context.user_data.pop('current_mode', None)
-        context.user_data.pop('current_path', None)
-        context.user_data.pop('file_list', None)
-        await show_file_list(update, context)
-        handled = True
-
-    if user_input == "Управление пользователями":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут управлять пользователями.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался использовать управление пользователями.")
+# Обработчик ошибок
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обработка ошибок бота."""
+    logger.error(f"Update {update} caused error {context.error}")
+    if update and update.message:
+        await update.message.reply_text("Произошла ошибка, попробуйте позже.")
+
+# Параллельная обработка обновлений
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))  # Сколько обновлений разных чатов обрабатывать одновременно
+UPDATE_CHAT_MAX_PENDING = int(os.getenv("UPDATE_CHAT_MAX_PENDING", "8"))  # Сколько обновлений одного чата может ждать очереди; лишние отбрасываются
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных чатов параллельно, а обновления одного чата — строго по очереди.
+
+    Состояние диалога в context.user_data (awaiting_fio, current_path, file_list и т. п.) меняется
+    только одним обработчиком за раз, поэтому быстрые повторные нажатия не перемешиваются.
+    Ожидающее своей очереди обновление занимает общий слот, поэтому у одного чата может ждать
+    не больше UPDATE_CHAT_MAX_PENDING обновлений: поток нажатий из одного чата не займёт все слоты.
+    На отброшенные нажатия кнопок бот отвечает всплывающей подсказкой, а на сообщения — одной просьбой подождать.
+    """
+
+    def __init__(self, max_concurrent_updates: int, chat_max_pending: int = UPDATE_CHAT_MAX_PENDING) -> None:
+        super().__init__(max_concurrent_updates)
+        self.chat_max_pending = chat_max_pending
+        self.dropped = 0
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_pending: Counter = Counter()
+        self._busy_notified: set = set()  # Чаты, которым уже сказали подождать, пока очередь не опустеет
+        self._running: set = set()  # Задачи обработки, которые ещё не завершились
+        self._cancelled = False
+
+    @staticmethod
+    def chat_key(update: object) -> int | None:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        return update.effective_user.id if update.effective_user is not None else None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._cancelled:
+            coroutine.close()
             return
-        keyboard = [
-            ['Добавить пользователя', 'Добавить администратора'],
-            ['Список пользователей', 'Список администраторов'],
-            ['Удалить файл'],
-            ['Назад']
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        context.user_data.pop('current_mode', None)
-        context.user_data.pop('current_path', None)
-        context.user_data.pop('file_list', None)
-        await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
-        logger.info(f"Администратор {user_id} запросил управление пользователями.")
-        handled = True
-
-    if user_input == "Загрузить файл":
-        profile = USER_PROFILES.get(user_id)
-        if not profile or "region" not in profile:
-            await update.message.reply_text("Ошибка: регион не определён. Обновите профиль с /start.",
-                                            reply_markup=default_reply_markup)
+        task = asyncio.current_task()
+        self._running.add(task)
+        try:
+            await self._process_in_chat_order(update, coroutine)
+        except asyncio.CancelledError:
+            coroutine.close()  # Если обработчик не успел начаться
+            raise
+        finally:
+            self._running.discard(task)
+
+    def cancel_all(self) -> int:
+        """Прерывает все выполняющиеся обработчики и отбрасывает ещё не начатые; возвращает число прерванных."""
+        self._cancelled = True
+        for task in self._running:
+            task.cancel()
+        return len(self._running)
+
+    async def _process_in_chat_order(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.chat_key(update)
+        if key is None:
+            await coroutine
             return
-        context.user_data.pop('current_mode', None)
-        context.user_data.pop('current_path', None)
-        context.user_data.pop('file_list', None)
-        await update.message.reply_text(
-            "Отправьте файл для загрузки.",
-            reply_markup=default_reply_markup
-        )
-        context.user_data['awaiting_upload'] = True
-        logger.info(f"Пользователь {user_id} начал загрузку файла.")
-        handled = True
-
-    if user_input == "Удалить файл":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут удалять файлы.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался удалить файл.")
+        if self._chat_pending[key] >= self.chat_max_pending:
+            coroutine.close()
+            self.dropped += 1
+            logger.warning(f"Чат {key} прислал слишком много обновлений подряд, обновление отброшено.")
+            await self._reply_busy(key, update)
             return
-        context.user_data['awaiting_delete'] = True
-        context.user_data.pop('current_mode', None)
-        context.user_data.pop('current_path', None)
-        context.user_data.pop('file_list', None)
-        await show_file_list(update, context, for_deletion=True)
-        handled = True
-
-    if user_input == "Назад":
-        await show_main_menu(update, context)
-        handled = True
-
-    if context.user_data.get('current_mode') == 'documents_nav':
-        current_path = context.user_data.get('current_path', '/documents/')
-        logger.info(f"Пользователь {user_id} пытается перейти в папку: {user_input}, текущий путь: {current_path}")
-        dirs = list_yandex_disk_directories(current_path)
-        if user_input in dirs:
-            context.user_data.pop('file_list', None)
-            context.user_data['current_path'] = f"{current_path.rstrip('/')}/{user_input}/"
-            logger.info(f"Пользователь {user_id} перешёл в папку: {context.user_data['current_path']}")
-            if not create_yandex_folder(context.user_data['current_path']):
-                await update.message.reply_text(
-                    f"Ошибка: не удалось создать папку {context.user_data['current_path']} (проверьте токен).",
-                    reply_markup=default_reply_markup)
-                logger.error(
-                    f"Не удалось создать папку {context.user_data['current_path']} для пользователя {user_id}.")
-                return
-            await show_current_docs(update, context)
-            handled = True
-        elif user_input == 'В главное меню':
-            logger.info(f"Пользователь {user_id} вернулся в главное меню из {current_path}")
-            await show_main_menu(update, context)
-            handled = True
-        elif user_input == 'Назад' and current_path != '/documents/':
-            context.user_data.pop('file_list', None)
-            parts = current_path.rstrip('/').split('/')
-            new_path = '/'.join(parts[:-1]) + '/' if len(parts) > 2 else '/documents/'
-            context.user_data['current_path'] = new_path
-            logger.info(f"Пользователь {user_id} вернулся назад в {new_path}")
-            await show_current_docs(update, context, is_return=True)
-            handled = True
-
-    if context.user_data.get('awaiting_user_id'):
+        # Блокировка берётся до первого await, поэтому порядок обновлений чата сохраняется
+        lock = self._chat_locks.setdefault(key, asyncio.Lock())
+        self._chat_pending[key] += 1
         try:
-            new_id = int(user_input)
-            if context.user_data['awaiting_user_id'] == 'add_user':
-                if new_id in ALLOWED_USERS:
-                    await update.message.reply_text(f"Пользователь с ID {new_id} уже имеет доступ.",
-                                                    reply_markup=default_reply_markup)
-                    return
-                ALLOWED_USERS.append(new_id)
-                save_allowed_users(ALLOWED_USERS)
-                await update.message.reply_text(f"Пользователь с ID {new_id} добавлен!",
-                                                reply_markup=default_reply_markup)
-                logger.info(f"Администратор {user_id} добавил пользователя {new_id}.")
-            elif context.user_data['awaiting_user_id'] == 'add_admin':
-                if new_id in ALLOWED_ADMINS:
-                    await update.message.reply_text(f"Пользователь с ID {new_id} уже администратор.",
-                                                    reply_markup=default_reply_markup)
-                    return
-                ALLOWED_ADMINS.append(new_id)
-                save_allowed_admins(ALLOWED_ADMINS)
-                await update.message.reply_text(f"Пользователь с ID {new_id} назначен администратором!",
-                                                reply_markup=default_reply_markup)
-                logger.info(f"Администратор {user_id} назначил администратора {new_id}.")
-            context.user_data.pop('awaiting_user_id', None)
-            handled = True
-        except ValueError:
-            await update.message.reply_text("Ошибка: user_id должен быть числом.", reply_markup=default_reply_markup)
-            logger.error(f"Ошибка: Неверный формат user_id от {user_id}.")
-            handled = True
+            async with lock:
+                await coroutine
+        finally:
+            self._chat_pending[key] -= 1
+            if not self._chat_pending[key]:
+                del self._chat_pending[key]
+                del self._chat_locks[key]
+                self._busy_notified.discard(key)
+
+    async def _reply_busy(self, key: int, update: Update) -> None:
+        """Сообщает пользователю, что его обновление отброшено, чтобы кнопка не «зависала» без ответа."""
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer("Подождите, предыдущий запрос ещё обрабатывается.")
+            elif update.effective_message is not None and key not in self._busy_notified:
+                self._busy_notified.add(key)
+                await update.effective_message.reply_text("Подождите, я ещё отвечаю на предыдущие сообщения.")
+        except Exception as e:
+            logger.error(f"Не удалось ответить на отброшенное обновление чата {key}: {str(e)}")
 
-    if user_input == "Добавить пользователя":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут добавлять пользователей.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался добавить пользователя.")
-            return
-        await update.message.reply_text("Укажите user_id для добавления.",
-                                        reply_markup=default_reply_markup)
-        context.user_data['awaiting_user_id'] = 'add_user'
-        logger.info(f"Администратор {user_id} запросил добавление пользователя.")
-        handled = True
+    async def initialize(self) -> None:
+        pass
 
-    if user_input == "Добавить администратора":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут назначать администраторов.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался добавить администратора.")
-            return
-        await update.message.reply_text("Укажите user_id для назначения администратором.",
-                                        reply_markup=default_reply_markup)
-        context.user_data['awaiting_user_id'] = 'add_admin'
-        logger.info(f"Администратор {user_id} запросил добавление администратора.")
-        handled = True
+    async def shutdown(self) -> None:
+        pass
 
-    if user_input == "Список пользователей":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут просматривать список пользователей.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался просмотреть список пользователей.")
-            return
-        if not ALLOWED_USERS:
-            await update.message.reply_text("Список пользователей пуст.", reply_markup=default_reply_markup)
+# Действия при запуске и остановке бота
+BACKGROUND_TASKS: List[asyncio.Task] = []  # Фоновые задачи, которые останавливаются вместе с ботом
+
+async def on_startup(app: Application) -> None:
+    """Создаёт корневые папки на Яндекс.Диске после запуска event loop."""
+    if not await create_yandex_folder('/regions/'):
+        logger.error("Не удалось создать папку /regions/ (проверьте YANDEX_TOKEN). Бот запустится, но функции Диска не будут работать.")
+    if not await create_yandex_folder('/documents/'):
+        logger.error("Не удалось создать папку /documents/ (проверьте YANDEX_TOKEN). Бот запустится, но функции Диска не будут работать.")
+    await warm_yandex_folder_cache('/regions/')
+    await warm_yandex_folder_cache('/documents/', recursive=True)
+    UPLOAD_QUEUE.start(app.bot)
+    BACKGROUND_TASKS.append(asyncio.create_task(prefetch_searches()))
+    BACKGROUND_TASKS.append(asyncio.create_task(evict_idle_histories()))
+    BACKGROUND_TASKS.append(asyncio.create_task(watch_access_lists()))
+
+async def on_stop(app: Application) -> None:
+    """Завершает загрузки на Диск, пока бот ещё может отправлять сообщения."""
+    await UPLOAD_QUEUE.stop(UPLOAD_DRAIN_TIMEOUT)
+
+async def on_shutdown(app: Application) -> None:
+    """Останавливает фоновые задачи и освобождает сетевые ресурсы при остановке бота."""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    await JSON_WRITER.flush()
+    await HISTORY_STORE.close()
+    USER_PROFILES.close()
+    await close_yandex_client()
+    await close_telegram_files_client()
+
+# Режим webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling — опрос Telegram, webhook — приём обновлений по HTTP
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес бота за обратным прокси, например https://bot.example.org
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")  # Путь, на который Telegram присылает обновления
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; обязателен в режиме webhook
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")  # Адрес, на котором слушает встроенный HTTP-сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))  # Порт встроенного HTTP-сервера
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # Сколько секунд при остановке дообрабатывать принятые обновления
+WEBHOOK_MAX_BODY = 1024 * 1024  # Максимальный размер тела запроса с обновлением
+
+class WebhookServer:
+    """ASGI-приложение: принимает обновления Telegram и кладёт их в очередь Application.
+
+    Обновления обрабатываются тем же ChatUpdateProcessor, что и при опросе, поэтому число
+    параллельных обработчиков задаёт UPDATE_CONCURRENCY. /healthz отвечает, пока процесс жив,
+    /readyz — пока бот запущен и принимает обновления.
+    """
+
+    def __init__(self, app: Application, path: str, secret: str) -> None:
+        self.app = app
+        self.path = path
+        self.secret = secret.encode()
+        self.ready = False
+        self.received = 0
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]],
+                       send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        if scope['type'] != 'http':
             return
-        users_list = "\n".join([f"ID: {uid}" for uid in ALLOWED_USERS])
-        await update.message.reply_text(f"Разрешённые пользователи:\n{users_list}", reply_markup=default_reply_markup)
-        logger.info(f"Администратор {user_id} запросил список пользователей.")
-        handled = True
-
-    if user_input == "Список администраторов":
-        if user_id not in ALLOWED_ADMINS:
-            await update.message.reply_text("Только администраторы могут просматривать список администраторов.",
-                                            reply_markup=default_reply_markup)
-            logger.info(f"Пользователь {user_id} попытался просмотреть список администраторов.")
+        if scope['path'] == '/healthz':
+            await self._respond(send, 200, b'ok')
+        elif scope['path'] == '/readyz':
+            await self._respond(send, 200 if self.ready else 503, b'ready' if self.ready else b'not ready')
+        elif scope['path'] == self.path and scope['method'] == 'POST':
+            await self._receive_update(scope, receive, send)
+        else:
+            await self._respond(send, 404, b'not found')
+
+    async def _receive_update(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]],
+                              send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        headers = dict(scope['headers'])
+        if not hmac.compare_digest(headers.get(b'x-telegram-bot-api-secret-token', b''), self.secret):
+            logger.warning(f"Отклонён запрос к webhook с неверным секретом от {scope.get('client')}")
+            await self._respond(send, 403, b'forbidden')
             return
-        if not ALLOWED_ADMINS:
-            await update.message.reply_text("Список администраторов пуст.", reply_markup=default_reply_markup)
+        if not self.ready:
+            # Telegram повторит доставку, когда бот снова будет готов
+            await self._respond(send, 503, b'not ready')
             return
-        admins_list = "\n".join([f"ID: {uid}" for uid in ALLOWED_ADMINS])
-        await update.message.reply_text(f"Администраторы:\n{admins_list}", reply_markup=default_reply_markup)
-        logger.info(f"Администратор {user_id} запросил список администраторов.")
-        handled = True
-
-    if not handled:
-        if chat_id not in histories:
-            histories[chat_id] = {"name": None, "messages": [{"role": "system", "content": system_prompt}]}
-
-        global KNOWLEDGE_BASE
-        if KNOWLEDGE_BASE:
-            knowledge_text = "Известные факты для использования в ответах: " + "; ".join(KNOWLEDGE_BASE)
-            histories[chat_id]["messages"].insert(1, {"role": "system", "content": knowledge_text})
-            logger.info(f"Добавлены знания в контекст для user_id {user_id}: {len(KNOWLEDGE_BASE)} фактов")
-
-        need_search = any(word in user_input.lower() for word in [
-            "актуальная информация", "последние новости", "найди в интернете", "поиск",
-            "что такое", "информация о", "расскажи о", "найди", "поиск по", "детали о",
-            "вскс", "спасатели", "корпус спасателей"
-        ])
-
-        if need_search:
-            logger.info(f"Выполняется поиск для запроса: {user_input}")
-            search_results_json = web_search(user_input)
-            try:
-                results = json.loads(search_results_json)
-                if isinstance(results, list):
-                    extracted_text = "\n".join(
-                        [f"Источник: {r.get('title', '')}\n{r.get('body', '')}" for r in results if r.get('body')])
-                else:
-                    extracted_text = search_results_json
-                histories[chat_id]["messages"].append({"role": "system", "content": f"Актуальные факты: {extracted_text}"})
-                logger.info(f"Извлечено из поиска: {extracted_text[:200]}...")
-            except json.JSONDecodeError:
-                histories[chat_id]["messages"].append(
-                    {"role": "system", "content": f"Ошибка поиска: {search_results_json}"})
-
-        histories[chat_id]["messages"].append({"role": "user", "content": user_input})
-        if len(histories[chat_id]["messages"]) > 20:
-            histories[chat_id]["messages"] = histories[chat_id]["messages"][:1] + histories[chat_id]["messages"][-19:]
-
-        messages = histories[chat_id]["messages"]
-
-        # Модели для HF (OpenAI-совместимые)
-        models_to_try = ["microsoft/DialoGPT-medium", "gpt2"]  # Примеры HF моделей; измените на нужные
-        response_text = "Извините, не удалось получить ответ от HF API. Проверьте HF_TOKEN и модель."
-
-        for model in models_to_try:
-            try:
-                # Для HF используем conversations API, но адаптируем под OpenAI
-                completion = client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    temperature=0.7,
-                    stream=False
-                )
-                response_text = completion.choices[0].message.content.strip()
-                logger.info(f"Ответ модели {model} для user_id {user_id}: {response_text}")
-                break
-            except openai.AuthenticationError as auth_err:
-                logger.error(f"Ошибка авторизации для {model}: {str(auth_err)}")
-                response_text = "Ошибка авторизации: неверный HF_TOKEN."
-                break
-            except openai.APIError as api_err:
-                if "401" in str(api_err):
-                    logger.warning(f"401 Unauthorized для {model}. Пробуем следующую модель.")
-                    continue
-                logger.error(f"Ошибка API для {model}: {str(api_err)}")
-                response_text = f"Ошибка API: {str(api_err)}"
-                break
-            except openai.RateLimitError as rate_err:
-                logger.error(f"Превышен лимит для {model}: {str(rate_err)}")
-                response_text = "Превышен лимит запросов. Попробуйте позже."
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > WEBHOOK_MAX_BODY:
+                await self._respond(send, 413, b'too large')
+                return
+            if not message.get('more_body'):
                 break
-            except Exception as e:
-                logger.error(f"Неизвестная ошибка для {model}: {str(e)}")
-                response_text = f"Неизвестная ошибка: {str(e)}"
+        try:
+            update = Update.de_json(json.loads(body), self.app.bot)
+        except Exception as e:
+            logger.error(f"Не удалось разобрать обновление из webhook: {str(e)}")
+            await self._respond(send, 400, b'bad update')
+            return
+        self.received += 1
+        await self.app.update_queue.put(update)
+        await self._respond(send, 200, b'ok')
+
+    @staticmethod
+    async def _respond(send: Callable[[Dict[str, Any]], Awaitable[None]], status: int, body: bytes) -> None:
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def drain(self, timeout: float) -> None:
+        """Ждёт, пока будут обработаны все принятые обновления; через timeout секунд прерывает оставшиеся."""
+        deadline = time.monotonic() + timeout
+        while not self.app.update_queue.empty() or self.app.update_processor.current_concurrent_updates:
+            if time.monotonic() >= deadline:
                 break
+            await asyncio.sleep(0.1)
         else:
-            logger.error("Все модели недоступны. Проверьте HF_TOKEN.")
-            response_text = "Все модели недоступны. Обновите HF_TOKEN."
-
-        user_name = USER_PROFILES.get(user_id, {}).get("name", "Друг")
-        final_response = f"{user_name}, {response_text}"
-        histories[chat_id]["messages"].append({"role": "assistant", "content": response_text})
-        await update.message.reply_text(final_response, reply_markup=default_reply_markup)
-
-# Обработчик ошибок
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обработка ошибок бота."""
-    logger.error(f"Update {update} caused error {context.error}")
-    if update and update.message:
-        await update.message.reply_text("Произошла ошибка, попробуйте позже.")
+            return
+        dropped = 0
+        while not self.app.update_queue.empty():
+            self.app.update_queue.get_nowait()
+            self.app.update_queue.task_done()
+            dropped += 1
+        cancelled = self.app.update_processor.cancel_all()
+        logger.warning(f"Не дождались обработки обновлений при остановке: отброшено из очереди {dropped}, "
+                       f"прервано обработчиков {cancelled}")
+
+async def run_webhook(app: Application) -> None:
+    """Запускает бота в режиме webhook со встроенным HTTP-сервером и корректно останавливает его."""
+    import uvicorn  # Нужен только в режиме webhook
+
+    if not WEBHOOK_SECRET:
+        # Доступ к боту проверяется только по from.id внутри обновления, поэтому без секрета
+        # любой, кто достучится до порта, сможет прислать обновление от имени администратора
+        raise ValueError("Для режима webhook необходимо задать WEBHOOK_SECRET")
+
+    class Server(uvicorn.Server):
+        """uvicorn без своих обработчиков сигналов: после serve() он заново посылает пойманный сигнал
+        процессу, и остановка бота (дообработка очереди, app.stop) не успевала бы выполниться."""
+
+        @contextlib.contextmanager
+        def capture_signals(self) -> Any:
+            yield
+
+        def install_signal_handlers(self) -> None:  # Старые версии uvicorn
+            pass
+
+    webhook = WebhookServer(app, WEBHOOK_PATH, WEBHOOK_SECRET)
+    server = Server(uvicorn.Config(webhook, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, lifespan='off',
+                                           log_config=None, timeout_graceful_shutdown=int(WEBHOOK_DRAIN_TIMEOUT)))
+
+    def request_exit() -> None:
+        # Повторный сигнал не дожидается открытых HTTP-запросов
+        if server.should_exit:
+            server.force_exit = True
+        server.should_exit = True
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_exit)
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL не задан: webhook в Telegram не регистрируется, обновления принимаются только локально.")
+        await app.start()
+        webhook.ready = True
+        logger.info(f"Приём обновлений на http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await server.serve()  # Возвращается после SIGINT/SIGTERM, дождавшись открытых запросов
+        finally:
+            webhook.ready = False
+            logger.info(f"Остановка: принято обновлений {webhook.received}, дообрабатываем очередь...")
+            await webhook.drain(WEBHOOK_DRAIN_TIMEOUT)
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+    finally:
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
 
 # Главная функция
 def main() -> None:
     """Запуск бота."""
     logger.info("Запуск Telegram бота...")
-    # Создание корневых папок с обработкой ошибок
-    if not create_yandex_folder('/regions/'):
-        logger.error("Не удалось создать папку /regions/ (проверьте YANDEX_TOKEN). Бот запустится, но функции Диска не будут работать.")
-    if not create_yandex_folder('/documents/'):
-        logger.error("Не удалось создать папку /documents/ (проверьте YANDEX_TOKEN). Бот запустится, но функции Диска не будут работать.")
     try:
-        app = Application.builder().token(TELEGRAM_TOKEN).build()
+        app = (Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(ChatUpdateProcessor(UPDATE_CONCURRENCY))
+               .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build())
         app.add_handler(CommandHandler("start", send_welcome))
         app.add_handler(CommandHandler("getfile", get_file))
         app.add_handler(CommandHandler("learn", handle_learn))
         app.add_handler(CommandHandler("forget", handle_forget))
+        app.add_handler(CommandHandler("uploads", show_upload_queue))
+        app.add_handler(CommandHandler("stats", show_stats))
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
         app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
         app.add_handler(CallbackQueryHandler(handle_callback_query))
         app.add_error_handler(error_handler)
-        app.run_polling()
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(app))
+        else:
+            app.run_polling()
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {str(e)}")
 
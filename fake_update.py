@@ -0,0 +1,61 @@
+"""Отправляет боту, запущенному с BOT_MODE=webhook, поддельное обновление Telegram.
+
+Пример:
+    python fake_update.py "Кто отвечает за форму?" --user-id 123456789
+    python fake_update.py /start --url http://localhost:8080/telegram --count 20
+
+Обновление проходит весь путь обработки, но ответ бот отправляет через настоящий Bot API,
+поэтому для несуществующего чата в логе будет ошибка отправки — это ожидаемо.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def make_update(text: str, user_id: int, chat_id: int) -> dict:
+    """Собирает обновление с текстовым сообщением в формате Bot API."""
+    update = {
+        "update_id": random.randint(1, 2 ** 31 - 1),
+        "message": {
+            "message_id": random.randint(1, 2 ** 31 - 1),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Тест"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        },
+    }
+    if text.startswith('/'):
+        command_length = len(text.split()[0])
+        update["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return update
+
+async def main() -> None:
+    port = os.getenv("WEBHOOK_PORT", "8080")
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    parser = argparse.ArgumentParser(description="Отправка поддельного обновления Telegram в webhook бота.")
+    parser.add_argument("text", help="Текст сообщения")
+    parser.add_argument("--user-id", type=int, default=123456789, help="ID отправителя")
+    parser.add_argument("--chat-id", type=int, help="ID чата (по умолчанию совпадает с ID отправителя)")
+    parser.add_argument("--url", default=f"http://localhost:{port}{path}", help="Адрес webhook")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""), help="Секрет webhook")
+    parser.add_argument("--count", type=int, default=1, help="Сколько обновлений отправить параллельно")
+    args = parser.parse_args()
+
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    async with httpx.AsyncClient(timeout=10) as client:
+        async def post() -> None:
+            started = time.monotonic()
+            response = await client.post(args.url, json=make_update(args.text, args.user_id, args.chat_id or args.user_id),
+                                         headers=headers)
+            print(f"{response.status_code} {response.text} за {(time.monotonic() - started) * 1000:.1f} мс")
+
+        await asyncio.gather(*(post() for _ in range(args.count)))
+
+if __name__ == "__main__":
+    asyncio.run(main())